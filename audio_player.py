@@ -1,37 +1,52 @@
 import argparse
 import atexit
+import io
 import logging
 import os
 import threading
 import time
 import webbrowser
-from collections import OrderedDict
+from contextlib import closing
 from multiprocessing import Process
 
 
 import dearpygui.dearpygui as dpg
 import pygame
-from demucs.api import save_audio
-from mutagen.mp3 import MP3
 from pygame import mixer
+from pygame import sndarray
 
-from audio_utils import remove_stems, StreamSession, load_session, save_session
-from model import separate, save_stems
+from audio_utils import get_library, remove_stems, load_session, save_session, add_songs, clear_songs, add_stem_set, clear_stem_sets, get_stem_set_model
+from library_scan import LibraryScanner, song_names
+from playlist import Playlist, SearchIndex
+from jobs import JobCancelled, JobScheduler, QueueFull, PRIORITY_CURRENT, PRIORITY_SAVE, PRIORITY_PREFETCH
+import profiling
+from stem_mixer import StemMixer
+from stem_store import EXT as STEM_FILE_EXT, is_stem_file, open_stem_file, resample
+from waveform import PeakIndex, load_or_compute, peaks_path, song_peaks_path
 
 #------------- Logging -------------#
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename='source_stream.log', level=logging.INFO)
 
-#------------- Thread monitoring Events and Data Structures -------------#
+#------------- Separation stack -------------#
 
-splitting_event = threading.Event()
-save_event = threading.Event()
-save_thread_event = threading.Event()
-curr_stem_pos = threading.Event()
-stem_events = {stem: threading.Event() for stem in ["vocals", "bass", "drums", "piano", "guitar", "other"]}
-stem_pos_thread = {}
-shutting_down_event = threading.Event()
+# torch and demucs take seconds to import, so `model` is only loaded when it is
+# first needed (or warmed in the background once the window is up)
+separation_lock = threading.Lock()
+separation = None
+
+def separation_stack():
+    global separation
+    with separation_lock:
+        if separation is None:
+            import model
+            model.configure_cpu(args.threads, args.interop_threads, args.quantize)
+            separation = model
+    return separation
+
+def warm_separation_stack():
+    threading.Thread(target=separation_stack, name="warm_separation", daemon=True).start()
 
 #------------- Audio Player Init and Params -------------#
 
@@ -40,17 +55,30 @@ pygame.init()
 mixer.init()
 mixer.music.set_volume(DEFAULT_VOL)
 MUSIC_END = pygame.USEREVENT+1
+# all stems are mixed into one stream played on this channel, in blocks of
+# STEM_BLOCK frames queued from the render loop
+STEM_BLOCK = 8192
+stem_channel = mixer.Channel(0)
+STEM_PANELS = ["vocals", "bass", "drums", "guitar", "piano", "other"]
 
 #------------- Session Init and Params -------------#
 
 dpg.create_context()
 parser = argparse.ArgumentParser()
 parser.add_argument("--name", default="null", help="Unique username. Use to cerate individualized accounts")
+parser.add_argument("--no-warmup", action="store_true", help="Don't load the separation models in the background at startup")
+parser.add_argument("--eager-imports", action="store_true", help="Import torch and demucs before the window is created")
+parser.add_argument("--bench-startup", action="store_true", help="Print the time of the first rendered frame and exit")
+parser.add_argument("--threads", type=int, default=None, help="Torch threads for CPU separation (default: torch's choice)")
+parser.add_argument("--interop-threads", type=int, default=None, help="Torch inter-op threads for CPU separation")
+parser.add_argument("--quantize", action="store_true", help="Run CPU separation with int8 dynamically quantized linear layers")
+parser.add_argument("--stem-precision", default="int16", choices=["float32", "float16", "int16"], help="Precision separated stems are held at in memory")
+parser.add_argument("--service", default=None, help="URL of a separation service (python -m separation_service) to split on instead of in this process")
+parser.add_argument("--prefetch-depth", type=int, default=2, help="Number of upcoming tracks to separate in the background when Prefetch is ticked")
 args = parser.parse_args()
-if os.path.exists(f"data/{args.name}.pickle"):
-    session = load_session(args.name)
-else:
-    session = StreamSession(args.name)
+session = load_session(args.name)
+if args.eager_imports:
+    separation_stack()
 
 #------------- Audio Player Functions -------------#
 
@@ -58,14 +86,48 @@ def update_volume(sender=None, app_data=None):
     if app_data is not None:
         mixer.music.set_volume(app_data / 100.0)
 
-def update_position():
-    while (mixer.music.get_busy() or session.PLAY_STATE != 'paused') and not shutting_down_event.is_set():
-        dpg.configure_item(item="curr_position",default_value=(mixer.music.get_pos()/1000)+session.OFFSET)
-        time.sleep(0.7)
-
-def progress_bar_handler():
-    slider_thread = threading.Thread(target=update_position, name="main_position", daemon=True)
-    slider_thread.start()
+#------------- Position scheduler -------------#
+
+# All position sliders are updated from the render loop off one shared clock:
+# the stem playhead is the offset at the last (re)start plus the time spent
+# playing since. Nothing runs while nothing is playing.
+POSITION_INTERVAL = 0.1
+stem_clock = {"offset": 0., "started": None}
+last_position_update = 0.
+
+def start_stem_clock():
+    if stem_clock["started"] is None:
+        stem_clock["started"] = time.time()
+
+def pause_stem_clock():
+    if stem_clock["started"] is not None:
+        stem_clock["offset"] += time.time() - stem_clock["started"]
+    stem_clock["started"] = None
+
+def reset_stem_clock(offset=0.):
+    stem_clock["offset"] = offset
+    stem_clock["started"] = None
+
+def stem_elapsed():
+    elapsed = stem_clock["offset"]
+    if stem_clock["started"] is not None:
+        elapsed += time.time() - stem_clock["started"]
+    return elapsed
+
+def update_positions():
+    global last_position_update
+    now = time.time()
+    if now - last_position_update < POSITION_INTERVAL:
+        return
+    last_position_update = now
+    if session.PLAY_STATE == "playing":
+        dpg.set_value("curr_position", mixer.music.get_pos()/1000 + session.OFFSET)
+    engine = session.STEM_MIXER
+    if engine is None or stem_clock["started"] is None:
+        return
+    elapsed = min(stem_elapsed(), engine.seconds(engine.length))
+    for stem in engine.names:
+        dpg.set_value(f"{stem}_position", elapsed)
 
 def global_pos_update(sender, data):
     current = mixer.music.get_pos()/1000 + session.OFFSET
@@ -73,30 +135,35 @@ def global_pos_update(sender, data):
     session.OFFSET += data-current
 
 def get_current_song():
-    if len(session.PLAYLIST.keys()):
-        return list(session.PLAYLIST.keys())[session.INDEX]
+    if len(session.PLAYLIST):
+        return session.PLAYLIST.name(session.INDEX)
     return "Add music to library"
 
 def get_current_song_path():
     if session.PLAY_STATE == None:
         dpg.show_item("play_popup")
         return None
-    return list(session.PLAYLIST.values())[session.INDEX]
+    return session.PLAYLIST.path(session.INDEX)
 
 def play(sender=None, app_data=None, user_data=None):
     song_name, song_path = user_data
     session.OFFSET = 0
-    session.INDEX = list(session.PLAYLIST.keys()).index(song_name)
+    session.INDEX = session.PLAYLIST.index(song_name)
     if user_data:
-        mixer.music.load(song_path)
-        current_audio = MP3(song_path)
-        dpg.configure_item(item="curr_position", max_value=current_audio.info.length)
-        dpg.configure_item(item="current_song", show=True, default_value=song_name)
+        mixer.music.load(*music_source(song_path))
         mixer.music.play()
         if mixer.music.get_busy():
             dpg.configure_item("play",label="Pause")
             session.PLAY_STATE="playing"
             mixer.music.set_endevent(MUSIC_END)
+        show_current_song(song_name, song_path)
+
+def show_current_song(song_name, song_path):
+    dpg.configure_item(item="curr_position", max_value=song_duration(song_path))
+    dpg.configure_item(item="current_song", show=True, default_value=song_name)
+    schedule_prefetch()
+    prefetch_next_track()
+    threading.Thread(target=load_song_waveform, args=(song_path,), daemon=True).start()
 
 def play_or_pause():        
     if session.PLAY_STATE == "playing":
@@ -115,201 +182,419 @@ def play_or_pause():
         dpg.show_item("play_popup")
 
 def restart_song():
-    prev_song = list(session.PLAYLIST.keys())[session.INDEX]
-    play(user_data=[prev_song, session.PLAYLIST[prev_song]])
+    play(user_data=[session.PLAYLIST.name(session.INDEX), session.PLAYLIST.path(session.INDEX)])
 
 def previous_song():
-    prev_song = list(session.PLAYLIST.keys())[session.INDEX-1]
     session.INDEX -= 1
-    play(user_data=[prev_song, session.PLAYLIST[prev_song]])
+    play(user_data=[session.PLAYLIST.name(session.INDEX), session.PLAYLIST.path(session.INDEX)])
 
 def next_song():
-    prev_song = list(session.PLAYLIST.keys())[(session.INDEX+1)%len(session.PLAYLIST)]
     session.INDEX += 1
-    play(user_data=[prev_song, session.PLAYLIST[prev_song]])
+    play(user_data=[session.PLAYLIST.name(session.INDEX), session.PLAYLIST.path(session.INDEX)])
 
 def stop():
     mixer.music.stop()
+    next_track["queued"] = False
     session.OFFSET = 0
     session.PLAY_STATE="stopped"
     dpg.configure_item("play",label="Play")
 
-def get_songs(sender, app_data):
-    song_dict = app_data['selections']
-    for name, song_path in song_dict.items():
-        session.USER_FILES["songs"][name] = song_path
+def song_duration(song_path):
+    try:
+        return scanner.track(song_path)["duration"] or 0.
+    except OSError:
+        return 0.
+
+def import_songs(paths):
+    def progress(done, total):
+        if done % 100 == 0 or done == total:
+            dpg.set_value("import_progress", f"Reading {done}/{total}")
+
+    dpg.set_value("import_progress", "Scanning...")
+    found, changed = scanner.scan(paths, progress=progress)
+    add_songs(session, song_names(found, session.USER_FILES["songs"]))
     load_database()
-    session.INDEX = 0
+    dpg.set_value("import_progress", f"{len(found)} songs, {changed} read")
+
+def get_songs(sender, app_data):
+    paths = list(app_data['selections'].values())
+    threading.Thread(target=import_songs, args=(paths,), name="import_songs", daemon=True).start()
+
+def get_folder(sender, app_data):
+    threading.Thread(target=import_songs, args=([app_data['file_path_name']],), name="import_songs", daemon=True).start()
 
 def load_database():
-    songs =  session.USER_FILES["songs"]
-    for filename, song_path in songs.items():
-        if not dpg.does_item_exist(filename):
-            dpg.add_button(label=filename, tag=filename, callback=play, width=-1,
-                        height=25, user_data=[filename, song_path], parent="songs")
-            
-            dpg.add_spacer(height=2, parent="songs")
-    
-    session.PLAYLIST = OrderedDict(songs)
-    session.INDEX = 0
+    session.PLAYLIST.extend(session.USER_FILES["songs"])
+    library_view["index"] = SearchIndex(session.PLAYLIST.names)
+    library_view["last"] = None
+    filter_library(app_data=dpg.get_value("song_search") if dpg.does_item_exist("song_search") else "")
 
 def removeallsongs():
-    session.USER_FILES["songs"] = {}
-    dpg.delete_item("songs", children_only=True)
-    session.PLAYLIST = OrderedDict()
+    clear_songs(session)
+    session.PLAYLIST = Playlist()
     session.INDEX = 0
+    load_database()
     dpg.configure_item("current_song", default_value="")
     dpg.hide_item("confirm_clear_songs")
 
+#------------- Library view -------------#
+
+# The song list is virtualized: a fixed pool of LIBRARY_ROWS buttons is moved
+# to the visible part of a spacer as tall as the whole (filtered) list and
+# relabelled from the render loop whenever the list scrolls or the filter
+# changes, so the widget count doesn't grow with the library.
+ROW_HEIGHT = 27
+LIBRARY_ROWS = 40
+library_view = {"rows": [], "index": SearchIndex([]), "last": None}
+
+def filter_library(sender=None, app_data=None):
+    # app_data: the search text
+    library_view["rows"] = library_view["index"].search(app_data or "")
+    library_view["last"] = None
+    if dpg.does_item_exist("songs_extent"):
+        dpg.configure_item("songs_extent", height=max(len(library_view["rows"]) * ROW_HEIGHT, 1))
+
+def add_library_rows():
+    dpg.add_spacer(tag="songs_extent", height=1, parent="songs")
+    for row in range(LIBRARY_ROWS):
+        dpg.add_button(tag=f"song_row_{row}", callback=play, width=-1, height=ROW_HEIGHT - 2, show=False, parent="songs")
+
+def update_library_view():
+    rows = library_view["rows"]
+    first = int(dpg.get_y_scroll("songs")) // ROW_HEIGHT
+    if library_view["last"] == first:
+        return
+    library_view["last"] = first
+    for row in range(LIBRARY_ROWS):
+        n = first + row
+        if n >= len(rows):
+            dpg.hide_item(f"song_row_{row}")
+            continue
+        index = rows[n]
+        name = session.PLAYLIST.names[index]
+        dpg.configure_item(f"song_row_{row}", label=name, user_data=[name, session.PLAYLIST.paths[index]],
+                           pos=(8, n * ROW_HEIGHT), show=True)
+
+# track metadata is read by a thread pool and cached in the library database
+scanner = LibraryScanner(get_library())
+
+#------------- Gapless playback -------------#
+
+# While a track plays, the next one's file is read into memory in the
+# background (with its cached metadata) and queued on mixer.music from the
+# render loop. Nothing is decoded ahead: mixer.music decodes as it plays and
+# waveform peaks are computed when the song is shown. pygame starts a queued
+# track from the audio thread the moment the current one ends, so MUSIC_END
+# only has to catch the UI up. Next also plays the in-memory copy instead of
+# going back to the disk.
+next_track = {"index": None, "path": None, "data": None, "queued": False}
+next_track_lock = threading.Lock()
+
+def music_source(song_path):
+    # arguments for mixer.music.load/queue: the prefetched bytes if they are
+    # for this song
+    with next_track_lock:
+        if next_track["path"] == song_path and next_track["data"] is not None:
+            return io.BytesIO(next_track["data"]), os.path.splitext(song_path)[1].lstrip(".")
+    return (song_path,)
+
+def read_next_track(index, song_path):
+    try:
+        with open(song_path, "rb") as f:
+            data = f.read()
+        song_duration(song_path)
+    except OSError as error:
+        logger.error(f"could not prefetch {song_path}: {error}")
+        return
+    with next_track_lock:
+        if next_track["index"] == index and next_track["path"] == song_path:
+            next_track["data"] = data
+
+def prefetch_next_track():
+    # called when a track starts: forgets the old handover and reads the next
+    # track in the background
+    if not len(session.PLAYLIST):
+        return
+    index = (session.INDEX + 1) % len(session.PLAYLIST)
+    song_path = session.PLAYLIST.path(index)
+    with next_track_lock:
+        next_track["queued"] = False
+        if next_track["path"] == song_path and next_track["data"] is not None:
+            next_track["index"] = index
+            return
+        next_track.update(index=index, path=song_path, data=None)
+    threading.Thread(target=read_next_track, args=(index, song_path), name="next_track", daemon=True).start()
+
+def queue_next_track():
+    # called from the render loop once the next track has been read
+    if session.PLAY_STATE != "playing" or next_track["queued"] or next_track["data"] is None:
+        return
+    try:
+        mixer.music.queue(*music_source(next_track["path"]))
+        next_track["queued"] = True
+    except pygame.error as error:
+        logger.error(f"could not queue {next_track['path']}: {error}")
+        next_track["data"] = None
+
+def track_ended():
+    # MUSIC_END: the queued track is already playing if the handover happened
+    if next_track["queued"] and mixer.music.get_busy():
+        next_track["queued"] = False
+        session.INDEX = next_track["index"]
+        session.OFFSET = 0
+        show_current_song(session.PLAYLIST.name(session.INDEX), session.PLAYLIST.path(session.INDEX))
+    else:
+        next_song()
+
+#------------- Waveforms -------------#
+
+# Song and stem waveforms are drawn from peak pyramids (see waveform.py). A
+# plot is redrawn from the pyramid level that matches its visible range
+# whenever it is zoomed or panned.
+WAVE_POINTS = 800
+wave_views = dict()
+last_wave_update = 0.
+
+def add_waveform_plot(tag, height):
+    with dpg.plot(tag=tag, height=height, width=-1, no_title=True, no_menus=True, no_box_select=True, no_mouse_pos=True):
+        dpg.add_plot_axis(dpg.mvXAxis, tag=f"{tag}_x", no_tick_labels=True)
+        with dpg.plot_axis(dpg.mvYAxis, tag=f"{tag}_y", no_tick_labels=True):
+            dpg.add_shade_series([], [], y2=[], tag=f"{tag}_series")
+    dpg.set_axis_limits(f"{tag}_y", -1, 1)
+
+def draw_waveform(tag, index, name, start=0., end=None):
+    end = index.duration if end is None else end
+    times, mins, maxs = index.view(name, start, end, WAVE_POINTS)
+    dpg.configure_item(f"{tag}_series", x=times.tolist(), y1=maxs.tolist(), y2=mins.tolist())
+    wave_views[tag] = (index, name, (start, end))
+
+def show_waveform(tag, index, name):
+    draw_waveform(tag, index, name)
+    dpg.fit_axis_data(f"{tag}_x")
+
+def show_stem_waveforms(index):
+    session.STEM_PEAKS = index
+    for name in index.names:
+        show_waveform(f"{name}_wave", index, name)
+
+def update_waveforms():
+    # called from the render loop
+    global last_wave_update
+    now = time.time()
+    if now - last_wave_update < POSITION_INTERVAL:
+        return
+    last_wave_update = now
+    for tag, (index, name, (start, end)) in list(wave_views.items()):
+        if not dpg.is_item_visible(tag):
+            continue
+        low, high = dpg.get_axis_limits(f"{tag}_x")
+        low, high = max(low, 0.), min(high, index.duration)
+        if high > low and (abs(low - start) + abs(high - end)) > 0.01 * (end - start):
+            draw_waveform(tag, index, name, low, high)
+
+def decode_song(song_path):
+    pcm = sndarray.array(mixer.Sound(song_path))
+    return pcm.reshape(pcm.shape[0], -1).T
+
+def load_song_waveform(song_path):
+    frequency = mixer.get_init()[0]
+
+    try:
+        index = load_or_compute(song_peaks_path(song_path), lambda: {"mix": decode_song(song_path)}, frequency)
+    except (OSError, pygame.error) as error:
+        logger.error(f"no waveform for {song_path}: {error}")
+        return
+    if session.PLAYLIST.get(get_current_song()) == song_path:
+        show_waveform("song_wave", index, "mix")
+
 #------------- Stem Splitting and Audio Player Functions -------------#
 
+def stem_pcm(stem, peak=None):
+    frequency, _, channels = mixer.get_init()
+    return separation_stack().stem_to_pcm(stem, session.STEM_SAMPLERATE, frequency, channels, peak=peak).T
+
+def feed_stem_output():
+    # called from the render loop: keeps one mixed block queued behind the
+    # one playing on the stem channel
+    engine = session.STEM_MIXER
+    if engine is None or session.ALL_STEMS != "playing":
+        return
+    if stem_channel.get_busy() and stem_channel.get_queue() is not None:
+        return
+    block = engine.mix(STEM_BLOCK)
+    if block is None:
+        if not stem_channel.get_busy():
+            if engine.complete:
+                stop_all_stems()
+            else:
+                # waiting on a streaming split
+                pause_stem_clock()
+        return
+    sound = mixer.Sound(buffer=block)
+    if stem_channel.get_busy():
+        stem_channel.queue(sound)
+    else:
+        if stem_clock["started"] is not None:
+            # the channel ran dry mid-playback
+            note_playback_strain()
+        stem_channel.play(sound)
+        start_stem_clock()
+
+def stem_names():
+    return session.STEM_MIXER.names if session.STEM_MIXER is not None else []
+
+def reset_stem_channels():
+    stem_channel.stop()
+    for stem in stem_names():
+        dpg.hide_item(stem)
+        wave_views.pop(f"{stem}_wave", None)
+    session.STEM_MIXER = None
+    session.ALL_STEMS = None
+    session.STEM_LENGTH.clear()
+    reset_stem_clock()
+
+def add_stem_panel(stem):
+    # one row of playback controls per stem; panels for stems beyond
+    # STEM_PANELS (e.g. "no_vocals" from a single-stem split) are added on demand
+    if dpg.does_item_exist(stem):
+        return
+    with dpg.child_window(autosize_x=True,show=False,height=140,no_scrollbar=True, tag=stem, parent="visualizer"):
+        with dpg.group(horizontal=True):
+            with dpg.group(horizontal=True):
+                dpg.add_button(label="Solo",tag=f"{stem}_solo",show=True,callback=solo_stem,width=65,height=30)
+                dpg.add_button(label="Mute",tag=f"{stem}_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
+                dpg.add_text("position: ", tag=f"{stem}_timer", label=str(0.0))
+                dpg.add_slider_float(tag=f"{stem}_position", callback=seek_stems, width=350,height=1, format=stem.replace("_", " ").capitalize())
+
+            dpg.add_slider_float(tag=f"{stem}_volume", label=f"{stem}_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
+        add_waveform_plot(f"{stem}_wave", 50)
+
+def init_stem_mixer(engine):
+    for name in engine.names:
+        add_stem_panel(name)
+    session.STEM_MIXER = engine
+    for name in engine.names:
+        session.STEM_LENGTH[name] = engine.seconds(engine.length)
+        dpg.configure_item(item=f"{name}_position", max_value=session.STEM_LENGTH[name], default_value=0.)
+        dpg.set_value(f"{name}_volume", DEFAULT_VOL * 100)
+        dpg.configure_item(f"{name}_solo", label="Solo")
+        dpg.configure_item(f"{name}_mute", label="Mute")
+
 def init_stem_channels(stems):
     stop_all_stems()
-    stop_all_stem_threads()
-    for stem in session.CHANNELS.keys():
-        dpg.hide_item(stem)
-    for n, (name, stem) in enumerate(stems.items()):
-        if name in stem_pos_thread.keys():
-            if stem_pos_thread[name].is_alive():
-                stem_events[name].set()
-        save_audio(stem, "temp.wav", session.STEM_SAMPLERATE)
-        session.CHANNELS[name] = mixer.Channel(n)
-        session.PYGAME_SOUNDS[name] = mixer.Sound("temp.wav")
-        session.STEM_OFFSETS[name] = 0
-        session.STEM_PLAY_STATE[name] = None
-        session.STEM_LEVELS[name] = DEFAULT_VOL
-        session.NAME_SPLIT_SONG = get_current_song()
-        session.STEM_LENGTH[name] = session.PYGAME_SOUNDS[name].get_length()
-        dpg.configure_item(item=f"{name}_position", max_value=session.STEM_LENGTH[name])
-
-    remove_stems("temp.wav")
-    for stem in stems.keys():
-        stem_events[stem].clear()
-        stopwatch_handler(stem)
+    reset_stem_channels()
+    frequency, _, channels = mixer.get_init()
+    with profiling.span("pygame_load", stems=len(stems)):
+        packed = getattr(stems, "audio", None)
+        if packed is not None and session.STEM_SAMPLERATE == frequency and packed.shape[1] == channels:
+            # play the packed int16 stems in place instead of converting a copy
+            audio = packed.numpy()
+            engine = StemMixer(stems.keys(), audio.shape[-1], channels, frequency, gain=DEFAULT_VOL, audio=audio, scales=stems.scales)
+        else:
+            pcms = {name: stem_pcm(stem) for name, stem in stems.items()}
+            engine = StemMixer.from_arrays(pcms, frequency, gain=DEFAULT_VOL)
+            profiling.count("stem_bytes_held", engine.audio.nbytes, buffer="mixer")
+        init_stem_mixer(engine)
+    session.NAME_SPLIT_SONG = get_current_song()
     dpg.configure_item("now_playing", default_value=f"Stems for: {session.NAME_SPLIT_SONG}")
 
-
 def play_or_pause_all_stems(): 
+    if session.STEM_MIXER is None:
+        return
     if session.ALL_STEMS == "playing":
-        mixer.pause()
+        stem_channel.pause()
+        pause_stem_clock()
         dpg.configure_item("all_play",label="Play All")
         session.ALL_STEMS = "paused"
-        for stem in session.STEM_PLAY_STATE.keys():
-            session.STEM_PLAY_STATE[stem] = "paused"
-            dpg.configure_item(f"{stem}_play",label="Play")
     elif session.ALL_STEMS == "paused":
-        mixer.unpause()
+        stem_channel.unpause()
+        start_stem_clock()
         dpg.configure_item("all_play",label="Pause All")
         session.ALL_STEMS = "playing"
-        for stem in session.STEM_PLAY_STATE.keys():
-            session.STEM_PLAY_STATE[stem] = "playing"
-            dpg.configure_item(f"{stem}_play",label="Pause")
     else:
-        for stem in session.CHANNELS.keys():
-            sound = session.PYGAME_SOUNDS[stem]
-            session.CHANNELS[stem].play(sound)
-            session.STEM_PLAY_STATE[stem] = "playing"
-            dpg.configure_item(f"{stem}_play",label="Pause")
+        reset_stem_clock(session.STEM_MIXER.seconds(session.STEM_MIXER.position))
         dpg.configure_item("all_play",label="Pause All")
         session.ALL_STEMS = "playing"
+        feed_stem_output()
 
 def stop_all_stems():
-    mixer.stop()
-    for stem in session.STEM_PLAY_STATE.keys():
-        session.STEM_PLAY_STATE[stem] = "stopped"
-        session.ALL_STEMS = None
-        dpg.configure_item(f"{stem}_play",label="Play")
+    stem_channel.stop()
+    reset_stem_clock()
+    session.ALL_STEMS = None
+    if session.STEM_MIXER is not None:
+        session.STEM_MIXER.seek(0)
+    for stem in stem_names():
         dpg.configure_item(f"{stem}_position",default_value=0.0)
     dpg.configure_item("all_play",label="Play All")
 
-def play_or_pause_stem(sender, data):
-    stem = sender.split("_")[0]
-    sound = session.PYGAME_SOUNDS[stem]
-    if session.STEM_PLAY_STATE[stem] == None:
-        session.CHANNELS[stem].play(sound)
-        session.STEM_PLAY_STATE[stem] = "playing"
-        dpg.configure_item(sender,label="Pause")
-    elif session.STEM_PLAY_STATE[stem] == "playing":
-        session.STEM_PLAY_STATE[stem] = "paused"
-        session.CHANNELS[stem].pause()
-        dpg.configure_item(sender,label="Play")
-    else:
-        session.STEM_PLAY_STATE[stem] = "playing"
-        session.CHANNELS[stem].unpause()
-        dpg.configure_item(sender,label="Pause")
+def seek_stems(sender, data):
+    engine = session.STEM_MIXER
+    if engine is None:
+        return
+    stem_channel.stop()
+    engine.seek(int(data * engine.samplerate))
+    reset_stem_clock(engine.seconds(engine.position))
+    for stem in engine.names:
+        dpg.set_value(f"{stem}_position", data)
+    if session.ALL_STEMS == "paused":
+        session.ALL_STEMS = "playing"
+        dpg.configure_item("all_play",label="Pause All")
+    feed_stem_output()
+
+def solo_stem(sender, data):
+    stem = sender.rsplit("_", 1)[0]
+    soloed = not session.STEM_MIXER.is_soloed(stem)
+    session.STEM_MIXER.set_soloed(stem, soloed)
+    dpg.configure_item(sender,label="Unsolo" if soloed else "Solo")
 
 def mute_unmute_stem(sender, data):
-    stem = sender.split("_")[0]
-    if session.STEM_LEVELS[stem] == "muted":
-        session.CHANNELS[stem].set_volume(0.25)
-        session.STEM_LEVELS[stem] = session.CHANNELS[stem].get_volume()
-        dpg.configure_item(sender,label="Mute")
-    else:
-        session.CHANNELS[stem].set_volume(0.0)
-        session.STEM_LEVELS[stem] = "muted"
-        dpg.configure_item(sender,label="Unmute")
+    stem = sender.rsplit("_", 1)[0]
+    muted = not session.STEM_MIXER.is_muted(stem)
+    session.STEM_MIXER.set_muted(stem, muted)
+    dpg.configure_item(sender,label="Unmute" if muted else "Mute")
 
 def set_stem_level(sender, app_data):
-    stem = sender.split("_")[0]
-    if app_data is not None:
-        curr_vol = session.CHANNELS[stem].get_volume()
-        if curr_vol == 0.0:
-            session.CHANNELS[stem].set_volume(app_data / 100.0)
-        else:
-            session.CHANNELS[stem].set_volume(app_data / (100.0*curr_vol + 1e-5))
-        if session.STEM_LEVELS[stem] == "muted":
+    stem = sender.rsplit("_", 1)[0]
+    if app_data is not None and session.STEM_MIXER is not None:
+        session.STEM_MIXER.set_gain(stem, app_data / 100.0)
+        if session.STEM_MIXER.is_muted(stem):
+            session.STEM_MIXER.set_muted(stem, False)
             dpg.configure_item(f"{stem}_mute",label="Mute")
-        session.STEM_LEVELS[stem] = app_data / 100.0
-
-def stopwatch(seconds, stem):
-    start = time.time()
-    offset = elapsed = 0.
-
-    while elapsed < float(seconds) and not stem_events[stem].is_set():
-        if "stopped" == session.STEM_PLAY_STATE[stem]:
-            start = time.time()
-            offset = elapsed = 0.
-            continue
-        elif "playing" != session.STEM_PLAY_STATE[stem]:
-            offset = time.time() - (elapsed + start)
-            continue
-        
-        elapsed = time.time() - start - offset
-        dpg.configure_item(f"{stem}_position", default_value=elapsed)
-        time.sleep(.7)
-
-def stopwatch_handler(stem):
-    if stem in stem_pos_thread.keys() and stem_pos_thread[stem].is_alive():
-        return
-    stem_pos_thread[stem] = None
-    stem_pos_thread[stem] = threading.Thread(target=stopwatch, args=[session.STEM_LENGTH[stem], stem])
-    stem_pos_thread[stem].start()
 
 def init_and_play_saved_stem_channels(data):
-    stop_all_stem_threads()
-    for stem in session.CHANNELS.keys():
-        dpg.hide_item(stem)
+    reset_stem_channels()
     stems = session.USER_FILES["stems"][data]
-    for n, (name, stem) in enumerate(stems.items()):
-        if name in stem_pos_thread.keys():
-            if stem_pos_thread[name].is_alive():
-                stem_events[name].set()
-        session.CHANNELS[name] = mixer.Channel(n)
-        session.PYGAME_SOUNDS[name] = mixer.Sound(stem)
-        session.STEM_OFFSETS[name] = 0
-        session.STEM_PLAY_STATE[name] = None
-        session.STEM_LEVELS[name] = DEFAULT_VOL
-        session.STEM_LENGTH[name] = session.PYGAME_SOUNDS[name].get_length()
-        dpg.configure_item(item=f"{name}_position", max_value=session.STEM_LENGTH[name])
-    
-    for item in ["all_play", "all_stop", "save_stems"]:
+    paths = set(stems.values())
+    frequency = mixer.get_init()[0]
+    load_start = time.perf_counter()
+    if len(paths) == 1 and is_stem_file(next(iter(paths))):
+        session.STEM_STORE_PATH = next(iter(paths))
+        header, audio = open_stem_file(session.STEM_STORE_PATH)
+        peaks = load_or_compute(peaks_path(session.STEM_STORE_PATH), lambda: dict(zip(header["stems"], audio)), header["samplerate"])
+        if header["samplerate"] != frequency:
+            audio = resample(audio, header["samplerate"], frequency)
+        engine = StemMixer(header["stems"], audio.shape[-1], audio.shape[1], frequency, gain=DEFAULT_VOL, audio=audio)
+    else:
+        session.STEM_STORE_PATH = None
+        pcms = dict()
+        for name, stem in stems.items():
+            pcm = sndarray.array(mixer.Sound(stem))
+            pcms[name] = pcm.reshape(pcm.shape[0], -1).T
+        engine = StemMixer.from_arrays(pcms, frequency, gain=DEFAULT_VOL)
+        peaks = load_or_compute(peaks_path(next(iter(stems.values()))), lambda: pcms, frequency)
+    profiling.add_span("pygame_load", time.perf_counter() - load_start, stems=len(stems), stem_set=data)
+    init_stem_mixer(engine)
+    show_stem_waveforms(peaks)
+    session.STEM_SET_NAME = data
+    session.STEM_SET_MODEL = get_stem_set_model(session, data)
+
+    dpg.hide_item("save_stems")
+    for item in ["all_play", "all_stop", "export_stems"]:
         dpg.show_item(item)
 
     for stem in stems.keys():
         dpg.show_item(stem)
-        stem_events[stem].clear()
-        stopwatch_handler(stem)
-        
+
     dpg.configure_item("now_playing", default_value=f"Stems for: {data}")
       
 def load_stems():
@@ -323,38 +608,152 @@ def load_selected_stems(sender, data):
             
 def clear_stems():
     for song in session.USER_FILES["stems"].keys():
-        for stem in session.USER_FILES["stems"][song].values():
+        for stem in set(session.USER_FILES["stems"][song].values()):
             remove_stems(stem)
     
-    for ctrl in ["all_play", "all_stop", "save_stems"]:
+    for ctrl in ["all_play", "all_stop", "save_stems", "export_stems"]:
         dpg.hide_item(ctrl)
-    for stem in session.CHANNELS.keys():
-        dpg.hide_item(stem)
-        if stem in stem_pos_thread.keys():
-            if stem_pos_thread[stem].is_alive():
-                stem_events[stem].set()
+    reset_stem_channels()
 
-    session.USER_FILES["stems"] = {}
+    clear_stem_sets(session)
     dpg.configure_item(items=load_stems(), item="load_stems")
     dpg.configure_item("now_playing", default_value=f"")
     dpg.hide_item("confirm_clear")
 
-def stop_all_stem_threads():
-    for stem in stem_pos_thread.keys():
-        if stem_pos_thread[stem].is_alive():
-            stem_events[stem].set()
-
 def get_model_selection(sender, data):
     session.MODEL_SELECTION = data
+    schedule_prefetch()
     return data
 
+def refresh_stats():
+    dpg.delete_item("stats_table", children_only=True, slot=1)
+    current = profiling.stats()
+    for name, stat in sorted(current["spans"].items()):
+        with dpg.table_row(parent="stats_table"):
+            dpg.add_text(name)
+            dpg.add_text(str(stat["count"]))
+            dpg.add_text(f"{stat['total_s']:.3f}")
+            dpg.add_text(f"{stat['total_s'] / stat['count']:.3f}")
+            dpg.add_text(f"{stat['max_s']:.3f}")
+    for name, value in sorted(current["counters"].items()):
+        with dpg.table_row(parent="stats_table"):
+            dpg.add_text(name)
+            dpg.add_text(str(value))
+            for _ in range(3):
+                dpg.add_text("")
+
+def show_stats():
+    refresh_stats()
+    dpg.show_item("stats_panel")
+
+def export_trace():
+    path = f"source_stream_trace_{int(time.time())}.jsonl"
+    written = profiling.export_trace(path)
+    dpg.set_value("stats_export", f"Wrote {written} events to {path}")
+
 def hyperlink(text, address):
     b = dpg.add_button(label=text, callback=lambda:webbrowser.open(address))
 
+#------------- Split and save jobs -------------#
+
+# Splits and saves run on the job scheduler (see jobs.py); the handlers below
+# run on its worker threads. Transient state (whether to stream, the stems to
+# save) travels in `job.payload`, which is not persisted: a job resumed after a
+# restart splits straight into the separation cache, or saves from it.
+
+def stem_set_name(model, song, one_stem=None):
+    # library names can hold a folder (see song_names); stem set names are
+    # one directory level
+    song_name = ".".join(song.replace("\\", "_").replace("/", "_").split(".")[:-1])
+    if one_stem is not None:
+        song_name = one_stem + "_" + song_name
+    return model + "_" + song_name
+
+def run_remote_split_job(job):
+    # splits on the separation service straight into a saved stem file
+    from separation_service import ServiceClient
+    client = ServiceClient(args.service)
+    name = stem_set_name(job.params["model"], os.path.basename(job.params["track"]), job.params.get("one_stem"))
+    params = dict(job.params, track=os.path.abspath(job.params["track"]), ext=STEM_FILE_EXT, name=name)
+    submitted = client.submit("split", params, priority=job.priority)
+    # keepalives let a queued or quiet request be cancelled within a second
+    with closing(client.events(submitted["id"], keepalive=1)) as events:
+        for event in events:
+            if job.cancel_event.is_set():
+                # a request shared with another client is left running
+                if not submitted["deduplicated"]:
+                    client.cancel(submitted["id"])
+                raise JobCancelled(job.id)
+            if event["event"] == "segment" and job.payload is not None and event.get("length"):
+                dpg.set_value("splitting_progress", f"{100 * event['offset'] / event['length']:.0f}%")
+    status = client.status(submitted["id"])
+    if status["state"] == "cancelled":
+        raise JobCancelled(job.id)
+    if status["state"] != "done":
+        raise RuntimeError(status["error"])
+    return {"name": name, "paths": status["result"]}
+
+def run_split_job(job):
+    if args.service:
+        return run_remote_split_job(job)
+    model, track = job.params["model"], job.params["track"]
+    quality = job.params.get("quality", "balanced")
+    one_stem = job.params.get("one_stem")
+    stack = separation_stack()
+    cache_key = stack.result_key(model, track, one_stem, quality=quality)
+    if job.payload is not None and job.payload.get("stream") and stack.stem_cache.contains(cache_key):
+        # already split (e.g. prefetched): load it instead of streaming again
+        job.payload["stream"] = False
+    if job.payload is not None and job.payload.get("stream"):
+        origin, stems = stream_split_song(model, track, quality, one_stem, job.cancel_event)
+        samplerate = session.STEM_SAMPLERATE
+    else:
+        separated = stack.separate([], model, track, one_stem=one_stem, cancel_event=job.cancel_event,
+                                   throttle=lambda: prefetch_throttle(job), quality=quality)
+        if separated is None:
+            raise RuntimeError(f"could not separate {track}")
+        origin, stems, samplerate = separated
+        if (job.payload is None or job.priority >= PRIORITY_PREFETCH) and not stack.stem_cache.contains(cache_key):
+            # nobody is waiting on a resumed split or a prefetch, so it goes to
+            # the cache right away
+            packed = stack.PackedTensor(origin, args.stem_precision), stack.PackedStems(stems, args.stem_precision)
+            stack.stem_cache.store(cache_key, *packed, samplerate)
+    params = dict(stack.separation_params(model, quality), one_stem=one_stem)
+    return origin, stems, samplerate, params
+
+def run_cache_job(job):
+    # writes a split the user is already listening to into the separation cache
+    origin, stems, samplerate = job.payload["stems"]
+    separation_stack().stem_cache.store(job.params["cache_key"], origin, stems, samplerate)
+
+def run_save_job(job):
+    stack = separation_stack()
+    if job.payload is not None:
+        origin, stems, samplerate = job.payload["stems"]
+    else:
+        cached = stack.stem_cache.lookup(job.params["cache_key"])
+        if cached is None:
+            raise RuntimeError("the stems to save are no longer in the separation cache")
+        origin, stems, samplerate = cached
+    progress = save_progress if job.payload is not None else None
+    return stack.save_stems(origin, stems, job.params["name"], job.params["model"], samplerate, [],
+                            ext=job.params["ext"], progress=progress, cancel_event=job.cancel_event,
+                            separation=job.params.get("separation"))[0]
+
+def finish_resumed_job(job):
+    if job.kind == "save" and job.state == "done":
+        add_stem_set(session, job.params["name"], job.result, model=job.params["model"])
+        dpg.configure_item(items=load_stems(), item="load_stems")
+    elif job.kind == "split" and job.state == "done" and isinstance(job.result, dict):
+        add_stem_set(session, job.result["name"], job.result["paths"], model=job.params["model"])
+        dpg.configure_item(items=load_stems(), item="load_stems")
+    logger.info(f"resumed {job.kind} job {job.id}: {job.state} {job.error or ''}")
+
+def split_device():
+    return "remote" if args.service else separation_stack().get_device()
+
 def split_song():
-    splitting_event.clear()
     model = session.MODEL_SELECTION
-    stop_all_stem_threads()
     if model is None:
         dpg.show_item("select_model_pop")
         return 
@@ -363,60 +762,247 @@ def split_song():
         dpg.show_item("play_popup")
         return 
     dpg.configure_item("separate_section", enabled=False)
-    results = []
-    sep_thread = threading.Thread(target=separate, args=[results, model, song_path])
-    sep_thread.start()
-    dpg.show_item("splitting")
-    while sep_thread.is_alive():
-        time.sleep(0.1)
-    dpg.hide_item("splitting")
+    params = {"model": model, "track": song_path, "quality": dpg.get_value("quality"), "one_stem": selected_one_stem()}
+    job = None
+    for prefetch in prefetch_jobs():
+        if prefetch.params == params:
+            # already being prefetched: take the job over instead of starting again
+            prefetch.payload = {"stream": False}
+            prefetch.persistent = True
+            job = scheduler.attach(prefetch.id, split_done, priority=PRIORITY_CURRENT)
+        else:
+            # frees the device for this split; prefetching restarts once it is done
+            scheduler.cancel(prefetch.id)
     try:
-        session.ORIGINAL_AUDIO, session.STEMS_CACHE, session.STEM_SAMPLERATE = results
-    except ValueError:
-        logger.error("splitting failed.")
+        if job is None:
+            job = scheduler.submit("split", params, priority=PRIORITY_CURRENT, device=split_device(),
+                                   on_done=split_done, payload={"stream": dpg.get_value("stream_split")})
+        session.SPLIT_JOB = job
+    except QueueFull as error:
+        logger.error(f"split not queued: {error}")
         dpg.configure_item("separate_section", enabled=True)
         return
-        
-    init_stem_channels(session.STEMS_CACHE)
+    dpg.show_item("splitting")
+
+def selected_one_stem():
+    stem = dpg.get_value("one_stem")
+    return None if stem == "all stems" else stem
+
+def split_done(job):
+    dpg.hide_item("splitting")
     dpg.configure_item("separate_section", enabled=True)
-    for ctrl in ["all_play", "all_stop", "save_stems"]:
+    if session.SPLIT_JOB is job:
+        session.SPLIT_JOB = None
+    schedule_prefetch()
+    if job.state != "done":
+        logger.error(f"splitting {job.state}. {job.error or ''}")
+        if job.payload.get("stream"):
+            reset_stem_channels()
+        return
+    model, song_path = job.params["model"], job.params["track"]
+    if isinstance(job.result, dict):
+        # split and saved by the separation service
+        add_stem_set(session, job.result["name"], job.result["paths"], model=model)
+        dpg.configure_item(items=load_stems(), item="load_stems")
+        dpg.configure_item("model_used", default_value=model)
+        init_and_play_saved_stem_channels(job.result["name"])
+        return
+    origin, stems, session.STEM_SAMPLERATE, session.STEM_PARAMS = job.result
+    # keep only the reduced-precision copies; the float32 result is dropped
+    job.result = None
+    session.ORIGINAL_AUDIO, session.STEMS_CACHE = separation_stack().pack_result(origin, stems, args.stem_precision)
+    del origin, stems
+    session.STEM_CACHE_KEY = separation_stack().result_key(model, song_path, job.params.get("one_stem"), quality=job.params["quality"])
+    dpg.configure_item("model_used", default_value=model)
+    dpg.show_item("save_stems")
+    if not job.payload.get("stream"):
+        init_stem_channels(session.STEMS_CACHE)
+    cache_split(session.STEM_CACHE_KEY)
+    engine = session.STEM_MIXER
+    show_stem_waveforms(PeakIndex.from_audio(dict(zip(engine.names, engine.audio)), engine.samplerate,
+                                             scales=dict(zip(engine.names, engine.scales * 32768))))
+    if job.payload.get("stream"):
+        return
+    for ctrl in ["all_play", "all_stop"]:
         dpg.show_item(ctrl)
     for stem in session.STEMS_CACHE.keys():
         dpg.show_item(stem)  
     dpg.configure_item("now_playing", default_value=f"Stems for: {session.NAME_SPLIT_SONG}")
-    dpg.configure_item("model_used", default_value=model)
-    return
 
-def handle_splitting():
-    split_function = threading.Thread(target=split_song)
-    split_function.start()
-    return
+def cache_split(cache_key):
+    # the cache write runs after the stems are playing, behind other work
+    if separation_stack().stem_cache.contains(cache_key):
+        return
+    stems = (session.ORIGINAL_AUDIO, session.STEMS_CACHE, session.STEM_SAMPLERATE)
+    try:
+        scheduler.submit("cache", {"cache_key": cache_key}, priority=PRIORITY_PREFETCH, device="encode",
+                         payload={"stems": stems}, persistent=False)
+    except QueueFull as error:
+        logger.error(f"split not cached: {error}")
+
+def stream_split_song(model, song_path, quality="balanced", one_stem=None, cancel_event=None):
+    stop_all_stems()
+    reset_stem_channels()
+    origin_chunks = []
+    stem_chunks = dict()
+    written = 0
+    for offset, length, samplerate, origin, stems, peak in separation_stack().separate_stream(model, song_path, quality, cancel_event=cancel_event, one_stem=one_stem):
+        origin_chunks.append(origin)
+        for name, stem in stems.items():
+            stem_chunks.setdefault(name, []).append(stem)
+        session.STEM_SAMPLERATE = samplerate
+        pcms = {name: stem_pcm(stem, peak) for name, stem in stems.items()}
+        if offset == 0:
+            frequency, _, channels = mixer.get_init()
+            frames = int(length * frequency / samplerate)
+            init_stem_mixer(StemMixer(stems.keys(), frames, channels, frequency, gain=DEFAULT_VOL))
+            profiling.count("stem_bytes_held", session.STEM_MIXER.audio.nbytes, buffer="mixer")
+        session.STEM_MIXER.write(written, pcms)
+        written += next(iter(pcms.values())).shape[-1]
+        if offset == 0:
+            session.NAME_SPLIT_SONG = get_current_song()
+            for name in stems.keys():
+                dpg.show_item(name)
+            for ctrl in ["all_play", "all_stop"]:
+                dpg.show_item(ctrl)
+            dpg.configure_item("now_playing", default_value=f"Stems for: {session.NAME_SPLIT_SONG}")
+            dpg.hide_item("splitting")
+            play_or_pause_all_stems()
+    # resampled chunks can round a few frames short of the estimate
+    session.STEM_MIXER.ready = session.STEM_MIXER.length
+    join_chunks = separation_stack().join_chunks
+    return join_chunks(origin_chunks), {name: join_chunks(chunks) for name, chunks in stem_chunks.items()}
+
+def save_progress(name, done, total):
+    dpg.set_value("saving_progress", f"Saved {name} ({done}/{total})")
 
-def save_stem_helper():
-    save_event.clear()
-    song_name = ".".join(session.NAME_SPLIT_SONG.split(".")[:-1])
+def handle_saving():
     model_used = dpg.get_value("model_used")
-    song_name = model_used + "_" + song_name
-    stems_paths = []
-    save_thread = threading.Thread(target=save_stems, args=[session.ORIGINAL_AUDIO, session.STEMS_CACHE, song_name, session.MODEL_SELECTION, session.STEM_SAMPLERATE, stems_paths])
-    save_thread.start()
+    song_name = stem_set_name(model_used, session.NAME_SPLIT_SONG, (session.STEM_PARAMS or {}).get("one_stem"))
+    params = {"name": song_name, "model": model_used, "cache_key": session.STEM_CACHE_KEY, "ext": STEM_FILE_EXT,
+              "separation": session.STEM_PARAMS}
+    stems = (session.ORIGINAL_AUDIO, session.STEMS_CACHE, session.STEM_SAMPLERATE)
+    for job in scheduler.pending("cache"):
+        if job.params["cache_key"] == session.STEM_CACHE_KEY:
+            # a save resumed after a restart reads the stems from the cache, so
+            # the cache write goes first (same priority, queued earlier)
+            scheduler.promote(job.id, PRIORITY_SAVE)
+    try:
+        session.SAVE_JOB = scheduler.submit("save", params, priority=PRIORITY_SAVE, device="encode",
+                                            on_done=save_done, payload={"stems": stems})
+    except QueueFull as error:
+        logger.error(f"save not queued: {error}")
+        return
+    dpg.set_value("saving_progress", "")
     dpg.show_item("saving")
-    while save_thread.is_alive():
-        time.sleep(0.1)
+
+def save_done(job):
     dpg.hide_item("saving")
-    try:
-        stems_paths = stems_paths[0]
-    except IndexError:
-        logger.debug("Saving failed.")
+    if session.SAVE_JOB is job:
+        session.SAVE_JOB = None
+    if job.state != "done":
+        logger.error(f"saving {job.state}. {job.error or ''}")
         return
-    
-    session.USER_FILES["stems"][song_name] = stems_paths
+    song_name, model_used = job.params["name"], job.params["model"]
+    add_stem_set(session, song_name, job.result, model=model_used)
+    session.STEM_STORE_PATH = next(iter(job.result.values()))
+    session.STEM_SET_NAME = song_name
+    session.STEM_SET_MODEL = model_used
     dpg.configure_item(items=load_stems(), item="load_stems")
+    dpg.show_item("export_stems")
 
-def handle_saving():
-    save_function = threading.Thread(target=save_stem_helper)
-    save_function.start()
-    save_event.clear()
+def run_export_job(job):
+    return separation_stack().export_stem_file(job.params["path"], job.params["model"], job.params["name"], [],
+                                               ext=job.params["ext"], progress=save_progress if job.payload else None)
+
+def export_done(job):
+    dpg.hide_item("saving")
+    if session.SAVE_JOB is job:
+        session.SAVE_JOB = None
+    if job.state != "done":
+        logger.error(f"exporting {job.state}. {job.error or ''}")
+
+def handle_exporting():
+    if session.STEM_STORE_PATH is None:
+        return
+    params = {"path": session.STEM_STORE_PATH, "model": session.STEM_SET_MODEL, "name": session.STEM_SET_NAME, "ext": "mp3"}
+    try:
+        session.SAVE_JOB = scheduler.submit("export", params, priority=PRIORITY_SAVE, device="encode",
+                                            on_done=export_done, payload={"interactive": True})
+    except QueueFull as error:
+        logger.error(f"export not queued: {error}")
+        return
+    dpg.set_value("saving_progress", "")
+    dpg.show_item("saving")
+
+scheduler = JobScheduler({"split": run_split_job, "save": run_save_job, "export": run_export_job, "cache": run_cache_job}, store=get_library())
+
+def cancel_job(job):
+    if job is not None:
+        scheduler.cancel(job.id)
+
+#------------- Prefetch -------------#
+
+# With Prefetch ticked, the next PREFETCH_DEPTH tracks in play order are split
+# with the selected model while the current one plays, and kept in the
+# separation cache so Separate on them is instant. Prefetch jobs run at the
+# lowest priority, are not persisted and wait between segments while playback
+# is short of CPU (stem underruns or slow frames in the last BACKOFF seconds).
+PREFETCH_DEPTH = args.prefetch_depth
+BACKOFF = 2.
+SLOW_FRAME = 0.1
+playback_strain = {"last": 0.}
+
+def note_playback_strain():
+    playback_strain["last"] = time.time()
+
+def playback_strained():
+    return time.time() - playback_strain["last"] < BACKOFF
+
+def prefetch_throttle(job):
+    if job.priority < PRIORITY_PREFETCH:
+        return
+    if any(other.state == "queued" and other.priority < job.priority and other.device == job.device
+           for other in scheduler.pending()):
+        # give the device up; prefetching is queued again once that job is done
+        job.cancel_event.set()
+        return
+    while job.priority >= PRIORITY_PREFETCH and playback_strained() and not job.cancel_event.is_set():
+        time.sleep(0.1)
+
+def upcoming_tracks():
+    # same order as next_song()
+    count = min(PREFETCH_DEPTH, len(session.PLAYLIST) - 1)
+    return [session.PLAYLIST.path(session.INDEX + n) for n in range(1, count + 1)]
+
+def prefetch_jobs():
+    return [job for job in scheduler.pending("split") if job.priority >= PRIORITY_PREFETCH]
+
+def prefetch_upcoming():
+    model = session.MODEL_SELECTION
+    # prefetching stays local: stems split by a service are always saved
+    enabled = dpg.get_value("prefetch") and model is not None and not args.service
+    quality, one_stem = dpg.get_value("quality"), selected_one_stem()
+    wanted = [{"model": model, "track": track, "quality": quality, "one_stem": one_stem} for track in upcoming_tracks()] if enabled else []
+    for job in prefetch_jobs():
+        if job.params not in wanted:
+            scheduler.cancel(job.id)
+    if not wanted:
+        return
+    stack = separation_stack()
+    queued = [job.params for job in scheduler.pending("split")]
+    for params in wanted:
+        if params in queued or not os.path.exists(params["track"]):
+            continue
+        if stack.stem_cache.contains(stack.result_key(model, params["track"], one_stem, quality=quality)):
+            continue
+        try:
+            scheduler.submit("split", params, priority=PRIORITY_PREFETCH, device=stack.get_device(), persistent=False)
+        except QueueFull:
+            break
+
+def schedule_prefetch(sender=None, app_data=None):
+    threading.Thread(target=prefetch_upcoming, name="prefetch", daemon=True).start()
 
 #------------- GUI -------------#
 
@@ -430,15 +1016,21 @@ with dpg.window(tag="main",label="window title", autosize=True):
             with dpg.file_dialog(directory_selector=False, show=False, callback=get_songs, tag="file_dialog_tag", width=700 ,height=400):
                 dpg.add_file_extension(".mp3", color=(255, 255, 0, 255))
                 dpg.add_file_extension(".wav", color=(255, 0, 255, 255))
+                dpg.add_file_extension(".flac", color=(0, 255, 255, 255))
+            dpg.add_file_dialog(directory_selector=True, show=False, callback=get_folder, tag="folder_dialog_tag", width=700, height=400)
 
             with dpg.group(horizontal=True):
                 dpg.add_button(label="Import Songs", callback=lambda: dpg.show_item("file_dialog_tag"))
+                dpg.add_button(label="Import Folder", callback=lambda: dpg.show_item("folder_dialog_tag"))
                 dpg.add_button(label="Clear Library", callback=lambda: dpg.show_item("confirm_clear_songs"))
+            dpg.add_text("", tag="import_progress")
             
             dpg.add_separator()
             dpg.add_spacer(height=2)
             dpg.add_spacer(height=3)
+            dpg.add_input_text(tag="song_search", hint="Search", width=-1, callback=filter_library)
             with dpg.child_window(autosize_x=True,tag="songs"):
+                add_library_rows()
                 load_database()
         
         with dpg.child_window(autosize_x=True,height=80,no_scrollbar=True, tag="control"):
@@ -474,16 +1066,22 @@ with dpg.window(tag="main",label="window title", autosize=True):
             dpg.add_text("", show=False, tag="model_used")
 
         with dpg.child_window(autosize_x=True, pos=(416, 100), tag="visualizer"):
+            add_waveform_plot("song_wave", 60)
             dpg.add_text("Separate current track or load saved stems:")
             dpg.add_spacer(height=2)
             dpg.add_spacer(height=5)
             with dpg.group(horizontal=True):
                 dpg.add_combo(["htdemucs", "htdemucs_ft", "htdemucs_6s"],  pos=(10, 50), tag="models", default_value="Choose a model", callback=get_model_selection, width=200)
                 dpg.add_button(label="About Models", tag="get_model_info", pos=(10, 80), width=100, height=20, callback=lambda: dpg.show_item("model_info"))
+                dpg.add_combo(["fast", "balanced", "best"], tag="quality", pos=(120, 80), default_value="balanced", width=90, callback=schedule_prefetch)
+                dpg.add_combo(["all stems"] + STEM_PANELS, tag="one_stem", pos=(220, 80), default_value="all stems", width=110, callback=schedule_prefetch)
                 dpg.add_button(label="Separate", tag="separate_section", pos=(250, 50), width=100, height=20, callback=split_song)
+                dpg.add_checkbox(label="Stream", tag="stream_split", pos=(360, 50), default_value=False)
+                dpg.add_checkbox(label="Prefetch", tag="prefetch", pos=(440, 50), default_value=False, callback=schedule_prefetch)
                 dpg.add_text("Load saved stems: ",  pos=(550, 50))
                 dpg.add_combo(load_stems(), tag="load_stems", default_value="Choose a song", callback=load_selected_stems, width=200, pos=(680, 50))
                 dpg.add_button(label="Delete Stems", tag="clear_stems", pos=(890, 50), width=100, height=20, callback=lambda: dpg.show_item("confirm_clear"))
+                dpg.add_button(label="Stats", tag="show_stats", pos=(1000, 50), width=60, height=20, callback=show_stats)
 
             dpg.add_spacer(height=12)
 
@@ -491,69 +1089,13 @@ with dpg.window(tag="main",label="window title", autosize=True):
                 dpg.add_button(label="Play All Stems",tag=f"all_play",show=False,callback=play_or_pause_all_stems, pos=(350, 100),width=110,height=30)
                 dpg.add_button(label="Stop Stems",tag=f"all_stop",show=False,callback=stop_all_stems, pos=(465, 100),width=110,height=30)
                 dpg.add_button(label="Save Stems",tag=f"save_stems",show=False,callback=handle_saving, pos=(580, 100),width=110,height=30)
+                dpg.add_button(label="Export MP3",tag=f"export_stems",show=False,callback=handle_exporting, pos=(695, 100),width=110,height=30)
         
             dpg.add_spacer(height=12)
 
             dpg.add_text("", show=True, tag="now_playing")
-            with dpg.child_window(autosize_x=True,show=False,height=80,no_scrollbar=True, tag="vocals"):
-                with dpg.group(horizontal=True):
-                    with dpg.group(horizontal=True):
-                        dpg.add_button(label="Play",tag=f"vocals_play",show=True,callback=play_or_pause_stem,width=65,height=30)
-                        dpg.add_button(label="Mute",tag=f"vocals_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
-                        dpg.add_text("elapsed time (not adjustable): ", tag="vocals_timer", label=str(0.0))
-                        dpg.add_slider_float(tag="vocals_position", width=350,height=1, format="Vocals")
-
-                    dpg.add_slider_float(tag="vocals_volume", label="vocals_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
-            
-            with dpg.child_window(autosize_x=True,show=False,height=80,no_scrollbar=True, tag="bass"):
-                with dpg.group(horizontal=True):
-                    with dpg.group(horizontal=True):
-                        dpg.add_button(label="Play",tag=f"bass_play",show=True,callback=play_or_pause_stem,width=65,height=30)
-                        dpg.add_button(label="Mute",tag=f"bass_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
-                        dpg.add_text("elapsed time (not adjustable): ", tag="bass_timer", label=str(0.0))
-                        dpg.add_slider_float(tag="bass_position", width=350,height=1, format="Bass")
-
-                    dpg.add_slider_float(tag="bass_volume", label="bass_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
-            
-            with dpg.child_window(autosize_x=True,show=False,height=80,no_scrollbar=True, tag="drums"):
-                with dpg.group(horizontal=True):
-                    with dpg.group(horizontal=True):
-                        dpg.add_button(label="Play",tag=f"drums_play",show=True,callback=play_or_pause_stem,width=65,height=30)
-                        dpg.add_button(label="Mute",tag=f"drums_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
-                        dpg.add_text("elapsed time (not adjustable): ", tag="drums_timer", label=str(0.0))
-                        dpg.add_slider_float(tag="drums_position", width=350,height=1, format="Drums")
-                    
-                    dpg.add_slider_float(tag="drums_volume", label="drums_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
-            
-            with dpg.child_window(autosize_x=True,show=False,height=80,no_scrollbar=True, tag="guitar"):
-                with dpg.group(horizontal=True):
-                    with dpg.group(horizontal=True):
-                        dpg.add_button(label="Play",tag=f"guitar_play",show=True,callback=play_or_pause_stem,width=65,height=30)
-                        dpg.add_button(label="Mute",tag=f"guitar_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
-                        dpg.add_text("elapsed time (not adjustable): ", tag="guitar_timer", label=str(0.0))
-                        dpg.add_slider_float(tag="guitar_position", width=350,height=1, format="Guitar")
-
-                    dpg.add_slider_float(tag="guitar_volume", label="guitar_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
-            
-            with dpg.child_window(autosize_x=True,show=False,height=80,no_scrollbar=True, tag="piano"):
-                with dpg.group(horizontal=True):
-                    with dpg.group(horizontal=True):
-                        dpg.add_button(label="Play",tag=f"piano_play",show=True,callback=play_or_pause_stem,width=65,height=30)
-                        dpg.add_button(label="Mute",tag=f"piano_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
-                        dpg.add_text("elapsed time (not adjustable): ", tag="piano_timer", label=str(0.0))
-                        dpg.add_slider_float(tag="piano_position", width=350,height=1, format="Piano")
-
-                    dpg.add_slider_float(tag="piano_volume", label="piano_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
-            
-            with dpg.child_window(autosize_x=True,show=False,height=80,no_scrollbar=True, tag="other"):
-                with dpg.group(horizontal=True):
-                    with dpg.group(horizontal=True):
-                        dpg.add_button(label="Play",tag=f"other_play",show=True,callback=play_or_pause_stem,width=65,height=30)
-                        dpg.add_button(label="Mute",tag=f"other_mute",show=True,callback=mute_unmute_stem,width=65,height=30)
-                        dpg.add_text("elapsed time (not adjustable): ", tag="other_timer", label=str(0.0))
-                        dpg.add_slider_float(tag="other_position", width=350,height=1, format="Other")
-
-                    dpg.add_slider_float(tag="other_volume", label="other_volume", width=200,height=30, pos=(800, 10), format="%.0f%.0%",default_value=DEFAULT_VOL * 100, callback=set_stem_level)
+            for stem in STEM_PANELS:
+                add_stem_panel(stem)
     
         with dpg.window(show=False, modal=True, tag="confirm_clear_songs", pos=(525, 100)):
             dpg.add_text("Are you sure you want to delete all songs?")
@@ -567,16 +1109,28 @@ with dpg.window(tag="main",label="window title", autosize=True):
 
         with dpg.window(show=False, modal=True, tag="saving", pos=(525, 100)):
             dpg.add_text("Saving in progress.")
-            #dpg.add_button(label="Cancel", tag="cancel_saving", pos=(50, 60), callback=lambda: save_event.set())
+            dpg.add_text("", tag="saving_progress")
+            dpg.add_button(label="Cancel", tag="cancel_saving", pos=(50, 60), callback=lambda: cancel_job(session.SAVE_JOB))
         
+        with dpg.window(show=False, tag="stats_panel", label="Pipeline stats", pos=(525, 100), width=620, height=400):
+            with dpg.group(horizontal=True):
+                dpg.add_button(label="Refresh", callback=refresh_stats)
+                dpg.add_button(label="Export Trace", callback=export_trace)
+                dpg.add_button(label="Reset", callback=lambda: (profiling.reset(), refresh_stats()))
+            dpg.add_text("", tag="stats_export")
+            with dpg.table(tag="stats_table", header_row=True, resizable=True):
+                for column in ["span / counter", "count", "total s", "mean s", "max s"]:
+                    dpg.add_table_column(label=column)
+
         with dpg.window(show=False, modal=True, tag="splitting", pos=(525, 100)):
             dpg.add_text("Splitting in progress.")
-            #dpg.add_button(label="Cancel", tag="cancel_splitting", pos=(60, 60), callback=lambda: splitting_event.set())
+            dpg.add_text("", tag="splitting_progress")
+            dpg.add_button(label="Cancel", tag="cancel_splitting", pos=(60, 60), callback=lambda: cancel_job(session.SPLIT_JOB))
 
 def safe_exit():
-    stop_all_stem_threads()
+    # running jobs stay queued in the library database and resume next start
+    scheduler.stop()
     save_session(session)
-    shutting_down_event.set()
     mixer.music.stop()
     pygame.quit()
 
@@ -588,14 +1142,32 @@ dpg.setup_dearpygui()
 dpg.show_viewport()
 dpg.set_primary_window("main", True)
 dpg.maximize_viewport()
-progress_bar_handler()
+first_frame = True
 #dpg.start_dearpygui()
 # below replaces, start_dearpygui()
 while dpg.is_dearpygui_running():
     # insert here any code you would like to run in the render loop
     # you can manually stop by using stop_dearpygui()
+    frame_start = time.time()
     for event in pygame.event.get():
         if event.type == MUSIC_END and session.PLAY_STATE == "playing":
-            next_song()
+            track_ended()
+    queue_next_track()
+    feed_stem_output()
+    update_positions()
+    update_waveforms()
+    update_library_view()
     dpg.render_dearpygui_frame()
+    if not first_frame and time.time() - frame_start > SLOW_FRAME:
+        note_playback_strain()
+    if first_frame:
+        first_frame = False
+        if args.bench_startup:
+            print(f"first_frame {time.time()}", flush=True)
+            dpg.stop_dearpygui()
+        elif not args.no_warmup:
+            warm_separation_stack()
+        if not args.bench_startup:
+            scheduler.start()
+            scheduler.resume(on_done=finish_resumed_job)
 dpg.destroy_context()
@@ -1,95 +1,79 @@
-import json
 import os
-import pickle
 
-from collections import OrderedDict
 from dataclasses import dataclass
 
+from library_store import LibraryStore
+from playlist import Playlist
+
+LIBRARY = None
+
+def get_library():
+    global LIBRARY
+    if LIBRARY is None:
+        LIBRARY = LibraryStore()
+        LIBRARY.migrate_legacy_data()
+    return LIBRARY
 
 def set_session_id(name):
-    if not os.path.isdir("data"):
-        os.makedirs("data")
-        sessions = {
-            "count": 0,
-            "users": {
-            },
-        }
-    else:
-        sessions = json.load(open("data/sessions.json", "r+"))
-    count = sessions["count"]
-    if name not in sessions["users"].keys():
-        user_id = count
-        sessions["users"][name] = count
-        count += 1
-        sessions["count"] = count
-        json.dump(sessions, open("data/sessions.json", 'w+'), indent=4)
-    else:
-        user_id = sessions["users"][name]
-    return user_id
+    return get_library().get_user_id(name)
 
 @dataclass
 class StreamSession:
     def __init__(self, 
                  name=None,
-                 playlist = OrderedDict(), 
-                 user_vol=0.25,
+                 playlist = None, 
                  ):
         
         self.name = name if name is not None else "null"
         self.session_id = set_session_id(self.name)
-        self.PLAYLIST = playlist
-        self.USER_VOL = user_vol
+        self.PLAYLIST = playlist if playlist is not None else Playlist()
+        self.USER_VOL = get_library().get_user_vol(self.session_id)
         self.PLAY_STATE = None
         self.OFFSET = 0
         self.INDEX = 0
         self.MODEL_SELECTION = None
-        self.CANCEL_SPLIT = False
-        self.CHANNELS = dict()
-        self.PYGAME_SOUNDS = dict()
-        self.STEM_OFFSETS = dict()
+        self.SPLIT_JOB = None
+        self.STEM_MIXER = None
         self.STEMS_CACHE = dict()
-        self.STEM_PLAY_STATE = dict()
-        self.STEM_LEVELS = dict()
         self.STEM_SAMPLERATE = None
-        self.USER_FILES = {
-            "songs": {},
-            "stems": {},
-        }
+        self.STEM_PARAMS = None
+        self.STEM_PEAKS = None
+        self.USER_FILES = get_library().load_user_files(self.session_id)
         self.NAME_SPLIT_SONG = None
         self.ALL_STEMS = None
-        self.KILL_SPLIT = False
+        self.SAVE_JOB = None
         self.ORIGINAL_AUDIO = None
         self.STEM_LENGTH = dict()
+        self.STEM_CACHE_KEY = None
+        self.STEM_STORE_PATH = None
+        self.STEM_SET_NAME = None
+        self.STEM_SET_MODEL = None
     
 def save_session(session):
-    session.PLAY_STATE = None
-    session.OFFSET = 0
-    session.INDEX = 0
-    session.MODEL_SELECTION = None
-    session.CANCEL_SPLIT = False
-    session.CHANNELS = dict()
-    session.PYGAME_SOUNDS = dict()
-    session.STEM_OFFSETS = dict()
-    session.STEMS_CACHE = dict()
-    session.STEM_PLAY_STATE = dict()
-    session.STEM_LEVELS = dict()
-    session.STEM_SAMPLERATE = None
-    session.NAME_SPLIT_SONG = None
-    session.ALL_STEMS = None
-    session.KILL_SPLIT = False
-    session.ORIGINAL_AUDIO = None
-    session.STEM_LENGTH = dict()
-    with open(f"data/{session.name}.pickle", "wb") as f:
-        pickle.dump(session, f)
+    # songs and stems are written as they change, only settings are left
+    get_library().set_user_vol(session.session_id, session.USER_VOL)
 
 def load_session(name):
-    with open(f"data/{name}.pickle", "rb") as f:
-        try:
-            session = pickle.load(f)
-        except EOFError:
-            print("session could not load, creating new session")
-            session = StreamSession(name)
-    return session
+    return StreamSession(name)
+
+def add_songs(session, songs):
+    get_library().add_songs(session.session_id, songs)
+    session.USER_FILES["songs"].update(songs)
+
+def clear_songs(session):
+    get_library().clear_songs(session.session_id)
+    session.USER_FILES["songs"] = {}
+
+def add_stem_set(session, name, stems, model=None):
+    get_library().add_stem_set(session.session_id, name, stems, model=model)
+    session.USER_FILES["stems"][name] = stems
+
+def get_stem_set_model(session, name):
+    return get_library().get_stem_set_model(session.session_id, name)
+
+def clear_stem_sets(session):
+    get_library().clear_stem_sets(session.session_id)
+    session.USER_FILES["stems"] = {}
 
 def remove_stems(path):
     assert os.path.isfile(path), "path must be a file"
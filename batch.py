@@ -0,0 +1,125 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac")
+
+def find_tracks(inputs):
+    tracks = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if name.lower().endswith(AUDIO_EXTENSIONS):
+                        tracks.append(os.path.join(root, name))
+        elif item.lower().endswith(AUDIO_EXTENSIONS):
+            tracks.append(item)
+        elif os.path.isfile(item):
+            # manifest: one track path per line, '#' for comments
+            with open(item, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        tracks.append(line)
+        else:
+            print(f"Skipping {item}: not a file or directory", file=sys.stderr)
+    return tracks
+
+def stem_dir(model_name, track):
+    return os.path.join("separated", model_name, os.path.basename(track).rsplit(".", 1)[0])
+
+def init_worker(threads, interop_threads=None, quantize=False):
+    from model import configure_cpu
+    configure_cpu(threads, interop_threads, quantize)
+
+def split_track(model_name, track, ext, cache, quality="balanced", one_stem=None, other_method="add"):
+    from model import separate, save_stems, result_key, separation_params
+
+    start = time.time()
+    separated = separate([], model_name, track, file_type=ext, quality=quality, one_stem=one_stem, other_method=other_method)
+    if separated is None:
+        return track, None, time.time() - start
+    origin, stems, samplerate = separated
+    cache_key = result_key(model_name, track, one_stem, other_method, quality) if cache else None
+    paths = save_stems(origin, stems, os.path.basename(track), model_name, samplerate, [], ext=ext, cache_key=cache_key,
+                       separation=dict(separation_params(model_name, quality), one_stem=one_stem))[0]
+    return track, paths, time.time() - start
+
+def split_on_service(args, tracks):
+    from separation_service import ServiceClient
+
+    client = ServiceClient(args.service)
+    params = {"model": args.model, "ext": args.ext, "quality": args.quality, "cache": args.cache,
+              "one_stem": args.one_stem, "other_method": args.other_method}
+    jobs = [(track, client.submit("split", dict(params, track=os.path.abspath(track)))["id"]) for track in tracks]
+    print(f"Sent {len(tracks)} tracks to {args.service}")
+    failed = []
+    start = time.time()
+    for n, (track, job_id) in enumerate(jobs, 1):
+        status = client.wait(job_id)
+        if status["state"] == "done":
+            print(f"[{n}/{len(tracks)}] {track} ({status['elapsed']:.1f}s)")
+        else:
+            failed.append(track)
+            print(f"[{n}/{len(tracks)}] {status['state']}: {track} {status['error'] or ''}", file=sys.stderr)
+    print(f"Done in {time.time() - start:.1f}s, {len(tracks) - len(failed)} separated, {len(failed)} failed.")
+    if failed:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Separate a batch of tracks into stems without the player.")
+    parser.add_argument("inputs", nargs="+", help="Audio files, directories (searched recursively) or manifest files listing one track per line")
+    parser.add_argument("--model", default="htdemucs", choices=["htdemucs", "htdemucs_ft", "htdemucs_6s"])
+    parser.add_argument("--quality", default="balanced", choices=["fast", "balanced", "best"], help="Separation quality preset")
+    parser.add_argument("--one-stem", default=None, help="Only keep this stem (e.g. vocals) and its complement")
+    parser.add_argument("--other-method", default="add", choices=["add", "minus", "none"],
+                        help="Complement for --one-stem: sum of the other stems, the mix minus the stem, or none")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: cores / threads)")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads per worker")
+    parser.add_argument("--interop-threads", type=int, default=None, help="Torch inter-op threads per worker")
+    parser.add_argument("--quantize", action="store_true", help="Run CPU inference with int8 dynamically quantized linear layers")
+    parser.add_argument("--ext", default="mp3", choices=["mp3", "wav", "flac", "stems"], help="'stems' writes one lossless file per track with every stem")
+    parser.add_argument("--service", default=None, help="URL of a separation service to send the tracks to instead of separating here")
+    parser.add_argument("--skip-existing", action="store_true", help="Skip tracks that already have a stem folder")
+    parser.add_argument("--cache", action="store_true", help="Also store results in the separation cache")
+    args = parser.parse_args()
+
+    tracks = find_tracks(args.inputs)
+    if args.skip_existing:
+        tracks = [track for track in tracks if not os.path.isdir(stem_dir(args.model, track))]
+    if not tracks:
+        print("No tracks to separate.")
+        return
+    if args.service:
+        split_on_service(args, tracks)
+        return
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+    workers = min(workers, len(tracks))
+    print(f"Separating {len(tracks)} tracks with {args.model} on {workers} workers x {args.threads} threads")
+
+    failed = []
+    start = time.time()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(args.threads, args.interop_threads, args.quantize)) as pool:
+        futures = [pool.submit(split_track, args.model, track, args.ext, args.cache, args.quality, args.one_stem, args.other_method) for track in tracks]
+        for n, future in enumerate(as_completed(futures), 1):
+            try:
+                track, paths, elapsed = future.result()
+            except Exception as error:
+                failed.append(str(error))
+                print(f"[{n}/{len(tracks)}] failed: {error}", file=sys.stderr)
+                continue
+            if paths is None:
+                failed.append(track)
+                print(f"[{n}/{len(tracks)}] failed: {track}", file=sys.stderr)
+            else:
+                print(f"[{n}/{len(tracks)}] {track} ({elapsed:.1f}s)")
+    print(f"Done in {time.time() - start:.1f}s, {len(tracks) - len(failed)} separated, {len(failed)} failed.")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline import git_commit, write_track
+
+def sdr(reference, estimate):
+    # signal to distortion ratio of `estimate` against `reference`, in dB
+    noise = ((reference - estimate) ** 2).sum().item()
+    signal = (reference ** 2).sum().item()
+    if noise == 0:
+        return float("inf")
+    return 10 * math.log10(max(signal, 1e-12) / noise)
+
+def run(model, model_name, track, quantize):
+    model.get_separator(model_name, device="cpu", quantize=quantize)
+    # the same random shifts for every run, so SDR only measures quantization
+    random.seed(0)
+    model.th.manual_seed(0)
+    start = time.perf_counter()
+    result = model.separate([], model_name, track, use_cache=False)
+    elapsed = time.perf_counter() - start
+    if result is None:
+        raise RuntimeError(f"could not separate {track} with {model_name}")
+    return elapsed, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU separation speed and quality across thread counts and int8 quantization.")
+    parser.add_argument("--model", default="htdemucs")
+    parser.add_argument("--track", default=None, help="Audio file to separate (default: synthetic audio)")
+    parser.add_argument("--seconds", type=float, default=20., help="Length of the synthetic audio")
+    parser.add_argument("--threads", type=int, nargs="*", default=[os.cpu_count() or 1], help="Intra-op thread counts to try")
+    parser.add_argument("--interop-threads", type=int, default=None)
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    import model
+
+    with tempfile.TemporaryDirectory() as workdir:
+        track = args.track or write_track(os.path.join(workdir, "track.wav"), args.seconds, 2)
+        audio_seconds = args.seconds if args.track is None else None
+        results = {"commit": git_commit(), "model": args.model, "track": args.track, "runs": []}
+        reference = None
+        for threads in args.threads:
+            for quantize in [False, True]:
+                profile = model.configure_cpu(threads, args.interop_threads, quantize)
+                elapsed, (origin, stems, samplerate) = run(model, args.model, track, quantize)
+                if audio_seconds is None:
+                    audio_seconds = origin.shape[-1] / samplerate
+                if reference is None:
+                    reference = stems
+                run_result = dict(profile, wall_s=elapsed, throughput_x=audio_seconds / elapsed)
+                run_result["sdr_db"] = {name: sdr(reference[name], stem) for name, stem in stems.items()}
+                results["runs"].append(run_result)
+                print(f"threads={threads} quantize={quantize}: {elapsed:.2f}s, "
+                      f"min SDR {min(run_result['sdr_db'].values()):.1f} dB", file=sys.stderr)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
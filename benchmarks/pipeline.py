@@ -0,0 +1,256 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLERATE = 44100
+TINY_SOURCES = ["drums", "bass", "other", "vocals"]
+
+#------------- Synthetic inputs -------------#
+
+def synthetic_audio(seconds, channels, samplerate=SAMPLERATE):
+    import torch as th
+
+    t = th.arange(int(seconds * samplerate)) / samplerate
+    tones = [th.sin(2 * math.pi * (110 * (c + 1)) * t) for c in range(channels)]
+    noise = 0.05 * th.randn(channels, t.shape[0])
+    return 0.3 * th.stack(tones) + noise
+
+def synthetic_stems(seconds, channels, sources=TINY_SOURCES):
+    audio = synthetic_audio(seconds, channels)
+    return audio, {name: audio / len(sources) for name in sources}
+
+def write_track(path, seconds, channels):
+    from demucs.api import save_audio
+    save_audio(synthetic_audio(seconds, channels), path, samplerate=SAMPLERATE)
+    return path
+
+#------------- Tiny stand-in model -------------#
+
+def tiny_separator(channels):
+    # a Separator whose model is a single 1x1 convolution, so the separation
+    # stage measures decoding, chunking and overlap-add rather than inference
+    import torch as th
+    from demucs.api import Separator
+
+    class TinyModel(th.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.sources = TINY_SOURCES
+            self.samplerate = SAMPLERATE
+            self.audio_channels = channels
+            self.segment = 7.8
+            self.conv = th.nn.Conv1d(channels, channels * len(TINY_SOURCES), 1)
+
+        def forward(self, mix):
+            out = self.conv(mix)
+            return out.view(mix.shape[0], len(self.sources), self.audio_channels, -1)
+
+    class TinySeparator(Separator):
+        def __init__(self):
+            self._name = "tiny"
+            self._repo = None
+            self._model = TinyModel().eval()
+            self._audio_channels = channels
+            self._samplerate = SAMPLERATE
+            self.update_parameter(device="cpu", shifts=1, overlap=0.25, split=True, segment=None,
+                                  jobs=0, progress=False, callback=None, callback_arg=None)
+
+    return TinySeparator()
+
+def register_model(model_name, channels):
+    import model
+    if model_name == "tiny":
+        separator = tiny_separator(channels)
+        model.MODEL_CACHE[(model_name, model.get_device(), False)] = (separator, model.model_size(separator))
+    return model
+
+#------------- Stages -------------#
+
+def stage_model_load(config):
+    import model
+    start = time.perf_counter()
+    model.get_separator(config["model"])
+    return time.perf_counter() - start, 0.
+
+def stage_separate(config):
+    model = register_model(config["model"], config["channels"])
+    track = write_track(os.path.join(config["workdir"], "track.wav"), config["seconds"], config["channels"])
+    model.get_separator(config["model"])
+    start = time.perf_counter()
+    result = model.separate([], config["model"], track, use_cache=False)
+    elapsed = time.perf_counter() - start
+    if result is None:
+        raise RuntimeError("separation failed")
+    return elapsed, config["seconds"]
+
+def stage_save_stems(config):
+    import model
+    origin, stems = synthetic_stems(config["seconds"], config["channels"])
+    start = time.perf_counter()
+    model.save_stems(origin, stems, "bench.wav", "bench", SAMPLERATE, [], ext=config["ext"])
+    return time.perf_counter() - start, config["seconds"] * len(stems)
+
+def stage_load_stems(config):
+    import model
+    from stem_mixer import StemMixer
+    _, stems = synthetic_stems(config["seconds"], config["channels"])
+    start = time.perf_counter()
+    pcms = {name: model.stem_to_pcm(stem, SAMPLERATE).T for name, stem in stems.items()}
+    StemMixer.from_arrays(pcms, SAMPLERATE)
+    return time.perf_counter() - start, config["seconds"] * len(stems)
+
+def stage_open_stem_file(config):
+    import model
+    from stem_mixer import StemMixer
+    from stem_store import open_stem_file
+    origin, stems = synthetic_stems(config["seconds"], config["channels"])
+    path = model.save_stems(origin, stems, "bench.wav", "bench", SAMPLERATE, [], ext="stems")[0]["vocals"]
+    start = time.perf_counter()
+    header, audio = open_stem_file(path)
+    StemMixer(header["stems"], audio.shape[-1], audio.shape[1], SAMPLERATE, audio=audio)
+    return time.perf_counter() - start, config["seconds"] * len(stems)
+
+def stage_read_stem_range(config):
+    # one second of two stems at 50 random positions in a stem file
+    import numpy as np
+    import model
+    from stem_store import open_stem_file
+    origin, stems = synthetic_stems(config["seconds"], config["channels"])
+    path = model.save_stems(origin, stems, "bench.wav", "bench", SAMPLERATE, [], ext="stems")[0]["vocals"]
+    header, audio = open_stem_file(path)
+    starts = np.random.default_rng(0).integers(0, max(audio.shape[-1] - SAMPLERATE, 1), 50)
+    start = time.perf_counter()
+    for frame in starts:
+        audio[:2, :, frame:frame + SAMPLERATE]
+    return time.perf_counter() - start, 50 * 2.
+
+def stage_mix(config):
+    import numpy as np
+    from stem_mixer import StemMixer
+    frames = int(config["seconds"] * SAMPLERATE)
+    pcms = {name: np.random.randint(-8000, 8000, (config["channels"], frames), dtype=np.int16) for name in TINY_SOURCES}
+    engine = StemMixer.from_arrays(pcms, SAMPLERATE)
+    start = time.perf_counter()
+    while engine.mix(8192) is not None:
+        pass
+    return time.perf_counter() - start, config["seconds"]
+
+def stage_session_io(config):
+    from library_store import LibraryStore
+    store = LibraryStore(os.path.join(config["workdir"], "library.db"))
+    user_id = store.get_user_id("bench")
+    songs = {f"song_{n}.mp3": f"/music/song_{n}.mp3" for n in range(config["songs"])}
+    start = time.perf_counter()
+    store.add_songs(user_id, songs)
+    for n in range(0, config["songs"], 10):
+        store.add_stem_set(user_id, f"bench_song_{n}", {name: f"/stems/{n}/{name}.mp3" for name in TINY_SOURCES}, model="bench")
+    store.load_user_files(user_id)
+    elapsed = time.perf_counter() - start
+    store.close()
+    return elapsed, 0.
+
+STAGES = {
+    "model_load": stage_model_load,
+    "separate": stage_separate,
+    "save_stems": stage_save_stems,
+    "load_stems": stage_load_stems,
+    "open_stem_file": stage_open_stem_file,
+    "read_stem_range": stage_read_stem_range,
+    "mix": stage_mix,
+    "session_io": stage_session_io,
+}
+
+#------------- Runner -------------#
+
+def run_stage(name, config, queue):
+    # runs in a fresh process so peak RSS belongs to this stage only
+    os.chdir(config["workdir"])
+    try:
+        elapsed, audio_seconds = STAGES[name](config)
+    except Exception as error:
+        queue.put({"error": f"{type(error).__name__}: {error}"})
+        return
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    queue.put({
+        "wall_s": elapsed,
+        "peak_rss_mb": peak_rss / 2**20,
+        "audio_s": audio_seconds,
+        "throughput_x": audio_seconds / elapsed if elapsed and audio_seconds else None,
+    })
+
+def measure(name, config):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    with tempfile.TemporaryDirectory() as workdir:
+        process = context.Process(target=run_stage, args=(name, dict(config, workdir=workdir), queue))
+        process.start()
+        process.join()
+        return queue.get() if not queue.empty() else {"error": f"exited with {process.exitcode}"}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    for key, stage in results["stages"].items():
+        before = baseline.get("stages", {}).get(key, {})
+        if "wall_s" in stage and "wall_s" in before:
+            change = stage["wall_s"] / before["wall_s"] - 1
+            print(f"{key:32s} {before['wall_s']:8.3f}s -> {stage['wall_s']:8.3f}s ({change:+.0%})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the separation, encoding, loading and session I/O paths.")
+    parser.add_argument("--seconds", type=float, default=30., help="Length of the synthetic audio")
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--songs", type=int, default=10000, help="Library size for the session I/O stage")
+    parser.add_argument("--models", nargs="*", default=[], help="Real Demucs models to benchmark if their weights can be loaded")
+    parser.add_argument("--ext", default="mp3", help="Format for the save_stems stage")
+    parser.add_argument("--stages", nargs="*", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="Baseline JSON file to compare against")
+    args = parser.parse_args()
+
+    config = {"seconds": args.seconds, "channels": args.channels, "songs": args.songs, "ext": args.ext, "model": "tiny"}
+    results = {"commit": git_commit(), "config": config, "stages": dict()}
+    for model_name in ["tiny"] + args.models:
+        for stage in args.stages:
+            if stage in ["model_load", "separate"]:
+                if stage == "model_load" and model_name == "tiny":
+                    continue
+                key = f"{stage}[{model_name}]"
+                results["stages"][key] = measure(stage, dict(config, model=model_name))
+            elif model_name == "tiny":
+                key = stage
+                results["stages"][key] = measure(stage, config)
+            else:
+                continue
+            print(f"{key}: {results['stages'][key]}", file=sys.stderr)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
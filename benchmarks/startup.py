@@ -0,0 +1,45 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def time_to_first_frame(extra_args):
+    start = time.time()
+    proc = subprocess.run(
+        [sys.executable, "audio_player.py", "--name", "__bench__", "--bench-startup", *extra_args],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith("first_frame "):
+            return float(line.split()[1]) - start
+    raise RuntimeError(f"player did not report a first frame:\n{proc.stderr}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the player's time to first frame.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = dict()
+    for label, extra_args in [("eager", ["--eager-imports"]), ("lazy", ["--no-warmup"])]:
+        times = [time_to_first_frame(extra_args) for _ in range(args.runs)]
+        results[label] = {
+            "median_s": statistics.median(times),
+            "min_s": min(times),
+            "runs": times,
+        }
+        print(f"{label}: median {results[label]['median_s']:.2f}s, min {results[label]['min_s']:.2f}s")
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
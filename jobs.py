@@ -0,0 +1,216 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+
+# Split and save requests run as jobs: a bounded priority queue served by a
+# few worker threads, with a concurrency limit per device, cooperative
+# cancellation and job state persisted in the library database so that jobs
+# interrupted by a restart are queued again.
+PRIORITY_CURRENT = 0
+PRIORITY_SAVE = 5
+PRIORITY_PREFETCH = 10
+
+DEVICE_LIMITS = {"cpu": 1, "cuda": 1, "mps": 1, "encode": 1}
+UNFINISHED = ("queued", "running")
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    pass
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind, params, priority=PRIORITY_CURRENT, device="cpu", job_id=None, on_done=None, payload=None, persistent=True):
+        # `params` must be JSON serializable and is all a resumed job gets back;
+        # `payload` holds in-memory data for this run only. Jobs that are not
+        # `persistent` are never written to the database.
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.payload = payload
+        self.persistent = persistent
+        self.priority = priority
+        self.device = device
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.elapsed = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+        self.on_done = [on_done] if on_done is not None else []
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.id)
+
+    def wait(self, timeout=None):
+        self.done_event.wait(timeout)
+        return self.result
+
+class JobScheduler:
+    def __init__(self, handlers, store=None, max_queue=32, device_limits=DEVICE_LIMITS, workers=3):
+        # handlers: {kind: function(job) -> result}
+        self.handlers = handlers
+        self.store = store
+        self.max_queue = max_queue
+        self.device_limits = dict(device_limits)
+        self.running = {device: 0 for device in self.device_limits}
+        self.queue = []
+        self.jobs = dict()
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.threads = [
+            threading.Thread(target=self.work, name=f"job_worker_{n}", daemon=True) for n in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            for job in self.jobs.values():
+                job.cancel_event.set()
+            self.cond.notify_all()
+
+    def persist(self, job):
+        if self.store is not None and job.persistent:
+            self.store.save_job(job.id, job.kind, job.params, job.priority, job.device, job.state, job.error)
+
+    def submit(self, kind, params, priority=PRIORITY_CURRENT, device="cpu", on_done=None, payload=None, job_id=None, persistent=True):
+        job = Job(kind, params, priority, device, job_id=job_id, on_done=on_done, payload=payload, persistent=persistent)
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                raise QueueFull(f"{len(self.queue)} jobs already queued")
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (job.priority, next(self.counter), job))
+            self.cond.notify_all()
+        self.persist(job)
+        return job
+
+    def resume(self, on_done=None):
+        # queues the jobs that were queued or running when the app last exited
+        if self.store is None:
+            return []
+        resumed = []
+        for job_id, kind, params, priority, device in self.store.load_jobs(UNFINISHED):
+            if kind in self.handlers:
+                try:
+                    resumed.append(self.submit(kind, params, priority, device, on_done=on_done, job_id=job_id))
+                except QueueFull:
+                    break
+        self.store.prune_jobs(UNFINISHED)
+        return resumed
+
+    def cancel(self, job_id):
+        # a queued job is dropped right away; a running one stops at its next
+        # cancellation check
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            job.cancel_event.set()
+            queued = [entry for entry in self.queue if entry[2] is not job]
+            dequeued = len(queued) != len(self.queue)
+            if dequeued:
+                self.queue = queued
+                heapq.heapify(self.queue)
+        if dequeued:
+            self.finish(job, "cancelled")
+        return True
+
+    def pending(self, kind=None):
+        with self.cond:
+            return [job for job in self.jobs.values() if job.state in UNFINISHED and (kind is None or job.kind == kind)]
+
+    def attach(self, job_id, on_done, priority=None):
+        # adds a completion callback to an unfinished job, optionally changing
+        # its priority; returns None if the job has already finished
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job.on_done.append(on_done)
+            if priority is not None:
+                self.promote(job_id, priority)
+            return job
+
+    def promote(self, job_id, priority):
+        # moves a queued job up (or down) the queue; a running job only gets
+        # its priority updated
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job.priority = priority
+            for n, entry in enumerate(self.queue):
+                if entry[2] is job:
+                    self.queue[n] = (priority, entry[1], job)
+                    heapq.heapify(self.queue)
+                    break
+            self.cond.notify_all()
+            return job
+
+    def next_job(self):
+        # highest priority job whose device still has a free slot
+        for entry in sorted(self.queue):
+            job = entry[2]
+            if self.running.get(job.device, 0) < self.device_limits.get(job.device, 1):
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                return job
+        return None
+
+    def work(self):
+        while True:
+            with self.cond:
+                job = None
+                while not self.stopped and job is None:
+                    job = self.next_job()
+                    if job is None:
+                        self.cond.wait()
+                if self.stopped:
+                    return
+                self.running[job.device] = self.running.get(job.device, 0) + 1
+                job.state = "running"
+            self.persist(job)
+            start = time.time()
+            try:
+                job.check_cancelled()
+                job.result = self.handlers[job.kind](job)
+                state = "done"
+            except JobCancelled:
+                state = "cancelled"
+            except Exception as error:
+                job.error = f"{type(error).__name__}: {error}"
+                state = "failed"
+            job.elapsed = time.time() - start
+            with self.cond:
+                self.running[job.device] -= 1
+                self.cond.notify_all()
+            if self.stopped and state == "cancelled":
+                # leave the job queued in the database so it resumes next time
+                continue
+            self.finish(job, state)
+
+    def finish(self, job, state):
+        job.state = state
+        self.persist(job)
+        with self.cond:
+            self.jobs.pop(job.id, None)
+            callbacks = list(job.on_done)
+        job.done_event.set()
+        for callback in callbacks:
+            # a failing callback must not take its worker thread down with it
+            try:
+                callback(job)
+            except Exception:
+                logger.exception(f"{job.kind} job {job.id}: on_done callback failed")
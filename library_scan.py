@@ -0,0 +1,135 @@
+import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+# Importing music walks the selected files and folders, reads each file's
+# duration, sample rate, channels and tags in a thread pool and caches them in
+# the library database keyed by path, mtime and size. A rescan only stats the
+# files and re-reads the ones that changed, so re-importing a large folder is
+# bound by the directory walk.
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac")
+TAG_KEYS = ("title", "artist", "album", "albumartist", "genre", "date", "tracknumber")
+WRITE_BATCH = 500
+
+def scan_files(inputs):
+    # (path, stat) for every audio file in `inputs`, searching folders recursively
+    for item in inputs:
+        if os.path.isdir(item):
+            yield from scan_dir(item)
+        elif item.lower().endswith(AUDIO_EXTENSIONS) and os.path.isfile(item):
+            yield os.path.abspath(item), os.stat(item)
+
+def scan_dir(path):
+    stack = [os.path.abspath(path)]
+    while stack:
+        try:
+            entries = sorted(os.scandir(stack.pop()), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        folders = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS) and entry.is_file():
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+        stack.extend(reversed(folders))
+
+def read_tags(tags):
+    if tags is None:
+        return {}
+    found = dict()
+    for key in TAG_KEYS:
+        try:
+            value = tags.get(key)
+        except (KeyError, ValueError):
+            continue
+        if value:
+            found[key] = str(value[0] if isinstance(value, list) else value)
+    return found
+
+def read_metadata(path, stat=None):
+    stat = stat or os.stat(path)
+    track = {"path": path, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "duration": None,
+             "samplerate": None, "channels": None, "tags": {}, "error": None}
+    try:
+        import mutagen
+        audio = mutagen.File(path, easy=True)
+        if audio is not None:
+            track["duration"] = audio.info.length
+            track["samplerate"] = getattr(audio.info, "sample_rate", None)
+            track["channels"] = getattr(audio.info, "channels", None)
+            track["tags"] = read_tags(audio.tags)
+        elif path.lower().endswith(".wav"):
+            # mutagen < 1.45 has no WAVE support
+            with wave.open(path, "rb") as f:
+                track["samplerate"] = f.getframerate()
+                track["channels"] = f.getnchannels()
+                track["duration"] = f.getnframes() / f.getframerate()
+        else:
+            track["error"] = "unsupported file"
+    except Exception as error:
+        track["error"] = f"{type(error).__name__}: {error}"
+    return track
+
+class LibraryScanner:
+    def __init__(self, store, workers=None):
+        self.store = store
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+
+    def scan(self, inputs, progress=None):
+        # returns (paths, changed): every audio file found and the number of
+        # files read again; progress(done, total) is called as changed files
+        # are read
+        known = self.store.get_track_stats()
+        found, stale = [], []
+        for path, stat in scan_files(inputs):
+            found.append(path)
+            if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                stale.append((path, stat))
+        self.forget_missing(inputs, known, set(found))
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            batch = []
+            for done, track in enumerate(pool.map(lambda item: read_metadata(*item), stale), 1):
+                batch.append(track)
+                if len(batch) >= WRITE_BATCH:
+                    self.store.save_tracks(batch)
+                    batch = []
+                if progress is not None:
+                    progress(done, len(stale))
+            self.store.save_tracks(batch)
+        return found, len(stale)
+
+    def forget_missing(self, inputs, known, found):
+        # drops cached files that are gone from the scanned folders
+        roots = tuple(os.path.join(os.path.abspath(item), "") for item in inputs if os.path.isdir(item))
+        if roots:
+            self.store.forget_tracks([path for path in known if path.startswith(roots) and path not in found])
+
+    def track(self, path):
+        # cached metadata for one file, read again if it changed
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        track = self.store.get_track(path)
+        if track is None or (track["mtime_ns"], track["size"]) != (stat.st_mtime_ns, stat.st_size):
+            track = read_metadata(path, stat)
+            self.store.save_tracks([track])
+        return track
+
+def song_names(paths, taken):
+    # library names for newly imported paths: the file name, the parent folder
+    # and file name when a different file already uses it, or else the path
+    names = dict()
+    owners = dict(taken)
+    for path in paths:
+        name = os.path.basename(path)
+        if owners.get(name, path) != path:
+            name = os.path.join(os.path.basename(os.path.dirname(path)), name)
+        if owners.get(name, path) != path:
+            name = path
+        owners[name] = path
+        names[name] = path
+    return names
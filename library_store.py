@@ -0,0 +1,243 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+DB_PATH = os.path.join("data", "library.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    user_vol REAL NOT NULL DEFAULT 0.25
+);
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    UNIQUE (user_id, name)
+);
+CREATE INDEX IF NOT EXISTS songs_name ON songs(name);
+CREATE INDEX IF NOT EXISTS songs_path ON songs(path);
+CREATE TABLE IF NOT EXISTS stem_sets (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    name TEXT NOT NULL,
+    model TEXT,
+    UNIQUE (user_id, name)
+);
+CREATE INDEX IF NOT EXISTS stem_sets_name ON stem_sets(name);
+CREATE INDEX IF NOT EXISTS stem_sets_model ON stem_sets(model);
+CREATE TABLE IF NOT EXISTS stems (
+    set_id INTEGER NOT NULL REFERENCES stem_sets(id) ON DELETE CASCADE,
+    stem TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (set_id, stem)
+);
+CREATE INDEX IF NOT EXISTS stems_path ON stems(path);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    device TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state);
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL,
+    samplerate INTEGER,
+    channels INTEGER,
+    tags TEXT,
+    error TEXT
+);
+"""
+
+class LibraryStore:
+    def __init__(self, path=DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def execute(self, query, params=()):
+        with self.lock, self.conn:
+            return self.conn.execute(query, params).fetchall()
+
+    def executemany(self, query, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(query, rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    #------------- Users -------------#
+
+    def get_user_id(self, name):
+        rows = self.execute("SELECT id FROM users WHERE name = ?", (name,))
+        if rows:
+            return rows[0][0]
+        self.execute("INSERT INTO users (name) VALUES (?)", (name,))
+        return self.execute("SELECT id FROM users WHERE name = ?", (name,))[0][0]
+
+    def get_user_vol(self, user_id):
+        return self.execute("SELECT user_vol FROM users WHERE id = ?", (user_id,))[0][0]
+
+    def set_user_vol(self, user_id, user_vol):
+        self.execute("UPDATE users SET user_vol = ? WHERE id = ?", (user_vol, user_id))
+
+    #------------- Songs -------------#
+
+    def add_songs(self, user_id, songs):
+        self.executemany(
+            "INSERT INTO songs (user_id, name, path) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, name) DO UPDATE SET path = excluded.path",
+            [(user_id, name, path) for name, path in songs.items()],
+        )
+
+    def clear_songs(self, user_id):
+        self.execute("DELETE FROM songs WHERE user_id = ?", (user_id,))
+
+    def get_songs(self, user_id):
+        rows = self.execute("SELECT name, path FROM songs WHERE user_id = ? ORDER BY id", (user_id,))
+        return dict(rows)
+
+    #------------- Stems -------------#
+
+    def add_stem_set(self, user_id, name, stems, model=None):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM stem_sets WHERE user_id = ? AND name = ?", (user_id, name))
+            set_id = self.conn.execute(
+                "INSERT INTO stem_sets (user_id, name, model) VALUES (?, ?, ?)", (user_id, name, model)
+            ).lastrowid
+            self.conn.executemany(
+                "INSERT INTO stems (set_id, stem, path) VALUES (?, ?, ?)",
+                [(set_id, stem, path) for stem, path in stems.items()],
+            )
+
+    def clear_stem_sets(self, user_id):
+        self.execute("DELETE FROM stem_sets WHERE user_id = ?", (user_id,))
+
+    def get_stem_sets(self, user_id):
+        rows = self.execute(
+            "SELECT stem_sets.name, stems.stem, stems.path FROM stem_sets "
+            "JOIN stems ON stems.set_id = stem_sets.id "
+            "WHERE stem_sets.user_id = ? ORDER BY stem_sets.id",
+            (user_id,),
+        )
+        stem_sets = dict()
+        for name, stem, path in rows:
+            stem_sets.setdefault(name, dict())[stem] = path
+        return stem_sets
+
+    def get_stem_set_model(self, user_id, name):
+        rows = self.execute("SELECT model FROM stem_sets WHERE user_id = ? AND name = ?", (user_id, name))
+        return rows[0][0] if rows else None
+
+    def load_user_files(self, user_id):
+        return {
+            "songs": self.get_songs(user_id),
+            "stems": self.get_stem_sets(user_id),
+        }
+
+    #------------- Jobs -------------#
+
+    def save_job(self, job_id, kind, params, priority, device, state, error=None):
+        self.execute(
+            "INSERT INTO jobs (id, kind, params, priority, device, state, error, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET state = excluded.state, error = excluded.error, updated = excluded.updated",
+            (job_id, kind, json.dumps(params), priority, device, state, error, time.time()),
+        )
+
+    def load_jobs(self, states):
+        marks = ", ".join("?" for _ in states)
+        rows = self.execute(
+            f"SELECT id, kind, params, priority, device FROM jobs WHERE state IN ({marks}) ORDER BY priority, updated",
+            tuple(states),
+        )
+        return [(job_id, kind, json.loads(params), priority, device) for job_id, kind, params, priority, device in rows]
+
+    def prune_jobs(self, keep_states):
+        # drops finished jobs, keeping the ones in `keep_states`
+        marks = ", ".join("?" for _ in keep_states)
+        self.execute(f"DELETE FROM jobs WHERE state NOT IN ({marks})", tuple(keep_states))
+
+    #------------- Track metadata -------------#
+
+    def get_track_stats(self):
+        # {path: (mtime_ns, size)} for every scanned file, to spot changed files
+        rows = self.execute("SELECT path, mtime_ns, size FROM tracks")
+        return {path: (mtime_ns, size) for path, mtime_ns, size in rows}
+
+    def save_tracks(self, tracks):
+        self.executemany(
+            "INSERT INTO tracks (path, mtime_ns, size, duration, samplerate, channels, tags, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size, "
+            "duration = excluded.duration, samplerate = excluded.samplerate, channels = excluded.channels, "
+            "tags = excluded.tags, error = excluded.error",
+            [
+                (track["path"], track["mtime_ns"], track["size"], track["duration"], track["samplerate"],
+                 track["channels"], json.dumps(track["tags"]), track["error"])
+                for track in tracks
+            ],
+        )
+
+    def get_track(self, path):
+        rows = self.execute(
+            "SELECT path, mtime_ns, size, duration, samplerate, channels, tags, error FROM tracks WHERE path = ?", (path,)
+        )
+        if not rows:
+            return None
+        path, mtime_ns, size, duration, samplerate, channels, tags, error = rows[0]
+        return {"path": path, "mtime_ns": mtime_ns, "size": size, "duration": duration, "samplerate": samplerate,
+                "channels": channels, "tags": json.loads(tags or "{}"), "error": error}
+
+    def forget_tracks(self, paths):
+        self.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in paths])
+
+    #------------- Migration -------------#
+
+    def migrate_legacy_data(self, data_dir="data"):
+        # one-time import of data/sessions.json and the pickled StreamSessions
+        if self.execute("SELECT value FROM meta WHERE key = 'legacy_migrated'"):
+            return
+        sessions_path = os.path.join(data_dir, "sessions.json")
+        if os.path.isfile(sessions_path):
+            with open(sessions_path, "r") as f:
+                users = json.load(f).get("users", {})
+            for name in sorted(users, key=users.get):
+                user_id = self.get_user_id(name)
+                pickle_path = os.path.join(data_dir, f"{name}.pickle")
+                if not os.path.isfile(pickle_path):
+                    continue
+                try:
+                    with open(pickle_path, "rb") as f:
+                        legacy = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, AttributeError):
+                    print(f"could not migrate session for {name}")
+                    continue
+                user_files = getattr(legacy, "USER_FILES", {"songs": {}, "stems": {}})
+                self.add_songs(user_id, user_files.get("songs", {}))
+                for stem_set, stems in user_files.get("stems", {}).items():
+                    self.add_stem_set(user_id, stem_set, stems)
+                self.set_user_vol(user_id, getattr(legacy, "USER_VOL", 0.25))
+        self.execute("INSERT INTO meta (key, value) VALUES ('legacy_migrated', '1')")
@@ -6,18 +6,32 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import json
 import os
+import random
 import sys
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import numpy as np
 import torch as th
 
 from demucs.api import Separator, save_audio
 
-from demucs.apply import BagOfModels
+from demucs.apply import BagOfModels, apply_model
+from demucs.audio import convert_audio, i16_pcm, prevent_clip
 from demucs.htdemucs import HTDemucs
 from demucs.pretrained import ModelLoadingError
 
+from jobs import JobCancelled
+import profiling
+import stem_cache
+import stem_store
+import waveform
+
 kwargs = {
     "bitrate": 320,
     "preset": 2,
@@ -26,78 +40,478 @@ kwargs = {
     "bits_per_sample": 16,
 }
 
-def save_stems(origin, stems, track, model_name, samplerate, result, directory=None, ext="mp3", other_method=None, one_stem=None, kwargs=kwargs):
+MODELS = ("htdemucs", "htdemucs_ft", "htdemucs_6s")
+
+#------------- Model cache -------------#
+
+# Loaded separators are kept per (model name, device) so repeated splits reuse
+# the weights. Least recently used models are evicted once the estimated size of
+# all cached weights goes over the budget; the most recent model is always kept.
+MODEL_CACHE = OrderedDict()
+MODEL_CACHE_BUDGET = int(os.environ.get("SOURCE_STREAM_MODEL_BUDGET_MB", 2048)) * 2**20
+model_cache_lock = threading.Lock()
+
+def get_device():
+    return "cuda" if th.cuda.is_available() else "mps" if th.backends.mps.is_available() else "cpu"
+
+def model_size(separator):
+    model = separator.model
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def set_model_cache_budget(megabytes):
+    global MODEL_CACHE_BUDGET
+    with model_cache_lock:
+        MODEL_CACHE_BUDGET = int(megabytes * 2**20)
+        evict_models()
+
+def evict_models():
+    total = sum(size for _, size in MODEL_CACHE.values())
+    while total > MODEL_CACHE_BUDGET and len(MODEL_CACHE) > 1:
+        _, (_, size) = MODEL_CACHE.popitem(last=False)
+        total -= size
+
+def clear_model_cache():
+    with model_cache_lock:
+        MODEL_CACHE.clear()
+    if th.cuda.is_available():
+        th.cuda.empty_cache()
+
+def get_separator(model_name, device=None, quantize=None):
+    device = get_device() if device is None else device
+    quantize = CPU_PROFILE["quantize"] if quantize is None else quantize
+    quantize = quantize and device == "cpu"
+    key = (model_name, device, quantize)
+    with model_cache_lock:
+        if key in MODEL_CACHE:
+            MODEL_CACHE.move_to_end(key)
+            profiling.count("model_cache_hit", model=model_name)
+            return MODEL_CACHE[key][0]
+        profiling.count("model_cache_miss", model=model_name)
+        with profiling.span("model_load", model=model_name, device=device):
+            separator = Separator(model=model_name,
+                                  device=device,
+                                  progress=True,
+                                  )
+        if quantize:
+            quantize_separator(separator)
+        MODEL_CACHE[key] = (separator, model_size(separator))
+        evict_models()
+        return separator
+
+#------------- CPU profile -------------#
+
+# Thread counts and dynamic int8 quantization for CPU inference. Quantization
+# replaces the nn.Linear layers (the HTDemucs transformer) with int8 versions
+# and only applies to separators loaded on the CPU.
+CPU_PROFILE = {"threads": None, "interop_threads": None, "quantize": False}
+
+def configure_cpu(threads=None, interop_threads=None, quantize=False):
+    if threads:
+        th.set_num_threads(threads)
+    if interop_threads:
+        try:
+            th.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # only allowed before torch starts any inter-op parallel work
+            print("Inter-op threads are already in use and can no longer be changed", file=sys.stderr)
+    CPU_PROFILE.update(
+        threads=th.get_num_threads(),
+        interop_threads=th.get_num_interop_threads(),
+        quantize=quantize,
+    )
+    return dict(CPU_PROFILE)
+
+def quantize_separator(separator):
+    models = separator.model.models if isinstance(separator.model, BagOfModels) else [separator.model]
+    with profiling.span("quantize", models=len(models)):
+        for model in models:
+            th.ao.quantization.quantize_dynamic(model, {th.nn.Linear}, dtype=th.qint8, inplace=True)
+    return separator
+
+def one_stem_result(origin, stems, one_stem, other_method="add"):
+    # Keeps `one_stem` and its complement: the sum of the other stems ("add",
+    # saved as no_<stem>) or the mix minus the stem ("minus", saved as
+    # minus_<stem>); "none" keeps the stem alone. A result that was already
+    # reduced is returned unchanged.
+    stems = stems if isinstance(stems, Mapping) else dict(stems)
+    if one_stem not in stems:
+        raise ValueError(f"no {one_stem} stem in {list(stems)}")
+    if set(stems) <= {one_stem, "no_" + one_stem, "minus_" + one_stem}:
+        return stems
+    reduced = {one_stem: stems[one_stem]}
+    if other_method == "add":
+        reduced["no_" + one_stem] = sum(stems[name] for name in stems if name != one_stem)
+    elif other_method == "minus":
+        reduced["minus_" + one_stem] = unpack(origin) - reduced[one_stem]
+    return reduced
+
+def encode_stem(name, source, path, samplerate, kwargs=kwargs):
+    with profiling.span("encode", stem=name, path=path):
+        save_audio(source, path, samplerate=samplerate, **kwargs)
+    profiling.count("bytes_written", os.path.getsize(path), path=path)
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled()
+
+def save_stems(origin, stems, track, model_name, samplerate, result, directory=None, ext="mp3", other_method="add", one_stem=None, kwargs=kwargs, cache_key=None, workers=None, progress=None, cancel_event=None, separation=None):
+    # `stems` is a dict or any iterable of (name, tensor) pairs; with an
+    # iterable each stem starts encoding as soon as it is produced.
+    # `progress(name, done, total)` is called after each stem is written.
+    # Setting `cancel_event` stops before the next stem is encoded (or, for a
+    # stem file, converted or written).
+    # `separation` (see separation_params) is recorded with the stems.
     out = "separated" + "/" +  model_name
     os.makedirs(out, exist_ok=True)
     filename ="{track}/{stem}.{ext}"
     out_dict = dict()
-    if one_stem is None:
-        for name, source in stems.items():
-            stem = out + "/" + filename.format(
-                track=track.rsplit(".", 1)[0],
-                trackext=track.rsplit(".", 1)[-1],
-                stem=name,
-                ext=ext,
-            )
-            stem_dir = "/".join(stem.split("/")[:-1])
-            out_dict[name] = stem
-            os.makedirs(stem_dir, exist_ok=True)
-            save_audio(source, str(stem), samplerate=samplerate, **kwargs)
-    else:
-        stem = out + "/" + filename.format(
-            track=track.rsplit(".", 1)[0],
-            trackext=track.rsplit(".", 1)[-1],
-            stem="minus_" + one_stem,
-            ext=ext,
-        )
-        if other_method == "minus":
-            stem_dir = "/".join(stem.split("/")[:-1])
-            out_dict[name] = stem
-            os.makedirs(stem_dir, exist_ok=True)
-            save_audio(origin - stems[one_stem], str(stem), samplerate=samplerate, **kwargs)
+    if one_stem is not None:
+        stems = one_stem_result(origin, stems, one_stem, other_method)
+    if ext == stem_store.EXT:
+        # every stem in one lossless, seekable stem file (see stem_store); only
+        # one stem at a time is converted back to float32
         stem = out + "/" + filename.format(
             track=track.rsplit(".", 1)[0],
             trackext=track.rsplit(".", 1)[-1],
-            stem=one_stem,
+            stem="all",
             ext=ext,
         )
-        stem_dir = "/".join(stem.split("/")[:-1])
-        out_dict[name] = stem
-        os.makedirs(stem_dir, exist_ok=True)
-        save_audio(stems.pop(one_stem), str(stem), samplerate=samplerate, **kwargs)
-        # Warning : after poping the stem, selected stem is no longer in the dict 'res'
-        if other_method == "add":
-            other_stem = th.zeros_like(next(iter(stems.values())))
-            for i in stems.values():
-                other_stem += i
-            stem = out + "/" + filename.format(
-                track=track.rsplit(".", 1)[0],
-                trackext=track.rsplit(".", 1)[-1],
-                stem="no_" + one_stem,
-                ext=ext,
-            )
-            stem_dir = "/".join(stem.split("/")[:-1])
-            out_dict[name] = stem
-            os.makedirs(stem_dir, exist_ok=True)
-            save_audio(other_stem, str(stem), samplerate=samplerate, **kwargs)
+        collected = dict()
+        pcms = dict()
+        for done, (name, source) in enumerate(stems.items() if isinstance(stems, Mapping) else stems, 1):
+            check_cancelled(cancel_event)
+            pcms[name] = stem_to_pcm(unpack(source), samplerate).T
+            if cache_key is not None and not isinstance(stems, Mapping):
+                collected[name] = source
+            if progress is not None:
+                # an iterable's length is only known once it is used up
+                progress(name, done, len(stems) if isinstance(stems, Mapping) else done)
+        check_cancelled(cancel_event)
+        with profiling.span("write_stem_file", path=stem):
+            stem_store.write_stem_file(stem, pcms, samplerate, metadata={"model": model_name, "track": track, "separation": separation})
+        profiling.count("bytes_written", os.path.getsize(stem), path=stem)
+        with profiling.span("waveform_peaks", stems=len(pcms)):
+            waveform.PeakIndex.from_audio(pcms, samplerate).save(waveform.peaks_path(stem))
+        out_dict = {name: stem for name in pcms}
+        if cache_key is not None:
+            stem_cache.store(cache_key, origin, stems if isinstance(stems, Mapping) else collected, samplerate)
+    else:
+        workers = workers or min(len(stems) if isinstance(stems, Mapping) else 6, os.cpu_count() or 1)
+        collected = dict()
+        futures = dict()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name, source in (stems.items() if isinstance(stems, Mapping) else stems):
+                if cancel_event is not None and cancel_event.is_set():
+                    pool.shutdown(cancel_futures=True)
+                    check_cancelled(cancel_event)
+                stem = out + "/" + filename.format(
+                    track=track.rsplit(".", 1)[0],
+                    trackext=track.rsplit(".", 1)[-1],
+                    stem=name,
+                    ext=ext,
+                )
+                stem_dir = "/".join(stem.split("/")[:-1])
+                out_dict[name] = stem
+                collected[name] = source
+                os.makedirs(stem_dir, exist_ok=True)
+                futures[pool.submit(encode_stem, name, source, str(stem), samplerate, kwargs)] = name
+            for done, future in enumerate(as_completed(futures), 1):
+                if cancel_event is not None and cancel_event.is_set():
+                    pool.shutdown(cancel_futures=True)
+                    check_cancelled(cancel_event)
+                future.result()
+                if progress is not None:
+                    progress(futures[future], done, len(futures))
+        if collected:
+            with profiling.span("waveform_peaks", stems=len(collected)):
+                peaks = {name: unpack(source).cpu().numpy() for name, source in collected.items()}
+                waveform.PeakIndex.from_audio(peaks, samplerate).save(waveform.peaks_path(next(iter(out_dict.values()))))
+        if cache_key is not None:
+            stem_cache.store(cache_key, origin, collected, samplerate)
+    if separation is not None and ext != stem_store.EXT and out_dict:
+        stem_dir = os.path.dirname(next(iter(out_dict.values())))
+        with open(os.path.join(stem_dir, "separation.json"), "w") as f:
+            json.dump(separation, f, indent=4)
     result.append(out_dict)
     return result
 
-def separate(result_list, model_name, track, file_type="mp3", one_stem=None, other_method=None):
-    device = "cuda" if th.cuda.is_available() else "mps" if th.backends.mps.is_available() else "cpu"
-    try:
-        separator = Separator(model=model_name,
-                              device=device,
-                              progress=True,
-                              )
-    except ModelLoadingError as error:
-        error.args[0]
+def stem_to_pcm(stem, samplerate, target_samplerate=None, channels=None, peak=None):
+    # int16 interleaved (samples, channels) array, ready for mixer.Sound(buffer=...)
+    # `peak` rescales against a fixed level (e.g. the whole track's) instead of
+    # this stem's own peak, so streamed chunks keep the same level
+    target_samplerate = samplerate if target_samplerate is None else target_samplerate
+    channels = stem.shape[0] if channels is None else channels
+    with profiling.span("stem_convert", frames=stem.shape[-1]):
+        wav = convert_audio(stem, samplerate, target_samplerate, channels)
+        if peak is not None and kwargs["clip"] == "rescale":
+            wav = (wav / max(1.01 * peak, 1)).clamp(-1, 1)
+        else:
+            wav = prevent_clip(wav, mode=kwargs["clip"])
+        return i16_pcm(wav.clone()).t().contiguous().numpy()
+
+#------------- Reduced precision -------------#
+
+# Separated audio held in memory can be stored as float16, or as int16 scaled
+# to each stem's peak, at half the size of float32. It is converted back to
+# float32 one stem at a time, only when something reads it (saving, loading
+# the playback buffers).
+PRECISIONS = ("float32", "float16", "int16")
+
+class PackedTensor:
+    def __init__(self, tensor, precision="int16", out=None):
+        # `out`, if given, is an int16 tensor the int16 samples are written to
+        self.precision = precision
+        self.scale = 1.
+        if precision == "float16":
+            self.data = tensor.to(th.float16)
+        elif precision == "int16":
+            peak = float(tensor.abs().max()) if tensor.numel() else 0.
+            self.scale = peak / 32767 if peak > 0 else 1.
+            self.data = th.round(tensor / self.scale).to(th.int16)
+            if out is not None:
+                out.copy_(self.data)
+                self.data = out
+        else:
+            self.data = tensor
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.numel() * self.data.element_size()
 
+    def unpack(self):
+        if self.precision == "float32":
+            return self.data
+        return self.data.to(th.float32) * self.scale
+
+class PackedStems(Mapping):
+    # read-only {name: float32 tensor} view over packed stems. int16 stems of
+    # the same shape share one (stems, channels, frames) array, `audio`, that
+    # StemMixer can play in place with `scales`.
+    def __init__(self, stems, precision="int16"):
+        self.precision = precision
+        self.audio = None
+        shapes = {tuple(stem.shape) for stem in stems.values()}
+        if precision == "int16" and len(shapes) == 1:
+            self.audio = th.empty((len(stems),) + shapes.pop(), dtype=th.int16)
+            self.packed = {name: PackedTensor(stem, precision, out=self.audio[n])
+                           for n, (name, stem) in enumerate(stems.items())}
+        else:
+            self.packed = {name: PackedTensor(stem, precision) for name, stem in stems.items()}
+
+    @property
+    def scales(self):
+        return [packed.scale for packed in self.packed.values()]
+
+    def __getitem__(self, name):
+        return self.packed[name].unpack()
+
+    def __iter__(self):
+        return iter(self.packed)
+
+    def __len__(self):
+        return len(self.packed)
+
+    @property
+    def nbytes(self):
+        return sum(packed.nbytes for packed in self.packed.values())
+
+def pack_result(origin, stems, precision="int16"):
+    with profiling.span("pack_stems", precision=precision):
+        origin = PackedTensor(origin, precision)
+        stems = PackedStems(stems, precision)
+    profiling.count("stem_bytes_held", origin.nbytes + stems.nbytes, precision=precision)
+    return origin, stems
+
+def unpack(tensor):
+    return tensor.unpack() if isinstance(tensor, PackedTensor) else tensor
+
+def join_chunks(chunks):
+    return th.cat(chunks, dim=-1)
+
+def get_max_segment(separator):
     max_allowed_segment = float('inf')
     if isinstance(separator.model, HTDemucs):
         max_allowed_segment = float(separator.model.segment)
     elif isinstance(separator.model, BagOfModels):
         max_allowed_segment = separator.model.max_allowed_segment
+    return max_allowed_segment
+
+#------------- Quality presets -------------#
+
+# Segment length (seconds, None for the model's own), overlap between segments
+# and number of random shifts averaged per segment. The model runs on about
+# shifts / (1 - overlap) segments per segment length of audio (at least one
+# pass): "fast" does no overlap and no shift, 1.33x quicker than "balanced",
+# for previewing; "best" averages 4 shifts over twice as many segments, about
+# 6x slower than "balanced".
+QUALITY_PRESETS = {
+    "fast": {"segment": None, "overlap": 0., "shifts": 0},
+    "balanced": {"segment": None, "overlap": 0.25, "shifts": 1},
+    "best": {"segment": None, "overlap": 0.5, "shifts": 4},
+}
+DEFAULT_QUALITY = "balanced"
+
+def quality_params(separator, quality=DEFAULT_QUALITY, segment=None, overlap=None, shifts=None):
+    # preset parameters, with any given overrides, checked against the model
+    params = dict(QUALITY_PRESETS[quality])
+    for name, value in [("segment", segment), ("overlap", overlap), ("shifts", shifts)]:
+        if value is not None:
+            params[name] = value
+    max_allowed_segment = get_max_segment(separator)
+    if params["segment"] is not None and params["segment"] > max_allowed_segment:
+        print(f"Cannot use a segment of {params['segment']}s with this model, "
+              f"using the maximum of {max_allowed_segment:.1f}s", file=sys.stderr)
+        params["segment"] = max_allowed_segment
+    if not 0 <= params["overlap"] < 1:
+        raise ValueError(f"overlap must be in [0, 1), got {params['overlap']}")
+    return params
+
+def separation_params(model_name, quality=DEFAULT_QUALITY, **overrides):
+    # parameters a split with `quality` runs with, as recorded next to saved stems
+    separator = get_separator(model_name)
+    params = quality_params(separator, quality, **overrides)
+    if params["segment"] is None:
+        max_allowed_segment = get_max_segment(separator)
+        params["segment"] = None if max_allowed_segment == float('inf') else max_allowed_segment
+    return dict(params, quality=quality, model=model_name)
+
+def separate_stream(model_name, track, quality=DEFAULT_QUALITY, segment=None, overlap=None, shifts=None, cancel_event=None, one_stem=None, other_method="add"):
+    # Separates `track` one segment at a time and yields
+    # (offset, total_length, samplerate, origin_chunk, stem_chunks, peak) as soon as each segment
+    # is final. Consecutive segments overlap by `overlap` and are cross-faded,
+    # so the concatenated chunks cover the whole track exactly once. With
+    # `one_stem` each chunk only holds that stem and its complement. `peak` is
+    # the whole track's peak, to convert every chunk at the same level.
+    separator = get_separator(model_name)
+    if one_stem is not None and one_stem not in separator.model.sources:
+        raise ValueError(f"{model_name} has no {one_stem} stem")
+    params = quality_params(separator, quality, segment, overlap, shifts)
+    segment, overlap, shifts = params["segment"], params["overlap"], params["shifts"]
+    if segment is None:
+        segment = get_max_segment(separator)
+    if segment == float('inf'):
+        segment = 10.
+    samplerate = separator.samplerate
+    with profiling.span("audio_decode", track=track):
+        wav = separator._load_audio(Path(track))
+    ref = wav.mean(0)
+    mean = ref.mean()
+    std = ref.std() + 1e-8
+    mix = (wav - mean) / std
+
+    length = wav.shape[-1]
+    peak = float(wav.abs().max())
+    # with shifts, each chunk is up to `max_shift` shorter than the segment so
+    # that every shifted window around it still fits in one segment
+    max_shift = int(0.5 * samplerate) if shifts else 0
+    window_length = int(segment * samplerate)
+    segment_length = window_length - max_shift
+    overlap_length = int(overlap * segment_length)
+    stride = segment_length - overlap_length
+    fade = th.linspace(0., 1., overlap_length)
+    tail = None
+    for offset in range(0, length, stride):
+        check_cancelled(cancel_event)
+        with th.inference_mode(), profiling.span("inference_segment", segment_offset=offset):
+            out = shifted_apply(separator.model, mix, offset, min(segment_length, length - offset),
+                                window_length, shifts, segment)
+        out = out * std + mean
+        if tail is not None:
+            n = min(overlap_length, out.shape[-1])
+            out[..., :n] = tail[..., :n] * (1 - fade[:n]) + out[..., :n] * fade[:n]
+        last = offset + segment_length >= length
+        if not last:
+            tail = out[..., stride:]
+            out = out[..., :stride]
+        origin = wav[:, offset:offset + out.shape[-1]]
+        stems = dict(zip(separator.model.sources, out))
+        if one_stem is not None:
+            stems = one_stem_result(origin, stems, one_stem, other_method)
+        yield offset, length, samplerate, origin, stems, peak
+        if last:
+            break
+
+def shifted_apply(model, mix, offset, chunk_length, window_length, shifts, segment):
+    # Separates mix[:, offset:offset + chunk_length]. Like apply_model's
+    # `shifts`, the input is shifted by a random offset of up to half a second
+    # and the outputs are averaged, but the shifted window is taken from the
+    # track around the chunk (zeros only past its ends) and never exceeds
+    # `window_length`, so the model runs on one segment per shift.
+    if not shifts:
+        chunk = mix[:, offset:offset + chunk_length]
+        return apply_model(model, chunk[None], shifts=0, split=False, segment=segment, device=get_device())[0]
+    max_shift = min(window_length - chunk_length, int(0.5 * model.samplerate))
+    out = 0.
+    for _ in range(shifts):
+        shift = random.randint(0, max_shift)
+        start = offset - shift
+        window = mix[:, max(start, 0):start + window_length]
+        window = th.nn.functional.pad(window, (max(-start, 0), 0))
+        separated = apply_model(model, window[None], shifts=0, split=False, segment=segment, device=get_device())[0]
+        out = out + separated[..., shift:shift + chunk_length]
+    return out / shifts
+
+def result_key(model_name, track, one_stem=None, other_method=None, quality=DEFAULT_QUALITY):
+    params = dict(QUALITY_PRESETS[quality])
+    other_method = (other_method or "add") if one_stem is not None else None
+    if CPU_PROFILE["quantize"] and get_device() == "cpu":
+        # int8 output differs from fp32; fp32 keys stay as they were
+        params["quantized"] = True
+    return stem_cache.track_key(track, model_name, one_stem=one_stem, other_method=other_method, **params)
+
+def export_stem_file(path, model_name, track, result, ext="mp3", progress=None):
+    # re-encodes a stem file, e.g. to mp3, with the usual save_stems layout
+    header, audio = stem_store.open_stem_file(path)
+    stems = (
+        (name, th.from_numpy(audio[n].astype(np.float32) / 32768))
+        for n, name in enumerate(header["stems"])
+    )
+    return save_stems(None, stems, track, model_name, header["samplerate"], result, ext=ext, progress=progress,
+                      separation=header["metadata"].get("separation"))
+
+def cancellable_callback(cancel_event, throttle=None, on_segment=None):
+    # Separator callback that records segment spans and aborts the separation
+    # (the Separator stops on KeyboardInterrupt) once `cancel_event` is set.
+    # `throttle()`, if given, is called before each segment and may block to
+    # hold the separation back; `on_segment(info)` after each one.
+    segment_callback = profiling.segment_callback()
+
+    def callback(info):
+        if info["state"] == "start" and throttle is not None:
+            throttle()
+        if cancel_event is not None and cancel_event.is_set():
+            raise KeyboardInterrupt
+        segment_callback(info)
+        if info["state"] == "end" and on_segment is not None:
+            on_segment(info)
+
+    return callback
+
+def separate(result_list, model_name, track, file_type="mp3", one_stem=None, other_method="add", use_cache=True, cancel_event=None, store_result=False, throttle=None, quality=DEFAULT_QUALITY, on_segment=None):
+    # `store_result` also keeps the result in the separation cache
+    cache_key = None
+    if use_cache and os.path.exists(track):
+        cache_key = result_key(model_name, track, one_stem, other_method, quality)
+        cached = stem_cache.lookup(cache_key)
+        if cached is not None:
+            print(f"Using cached stems for {track}")
+            result_list.extend(cached)
+            return cached
+    try:
+        separator = get_separator(model_name)
+    except ModelLoadingError as error:
+        print(error.args[0], file=sys.stderr)
+        return
+
+    params = quality_params(separator, quality)
+    if one_stem is not None and one_stem not in separator.model.sources:
+        print(f"{model_name} has no {one_stem} stem, choose one of {', '.join(separator.model.sources)}", file=sys.stderr)
+        return
 
     if isinstance(separator.model, BagOfModels):
         print(
@@ -116,10 +530,23 @@ def separate(result_list, model_name, track, file_type="mp3", one_stem=None, oth
         return
     print(f"Separating track {track}")
     ext = file_type
-    origin, res = separator.separate_audio_file(Path(track))
+    with profiling.span("audio_decode", track=track):
+        wav = separator._load_audio(Path(track))
+    check_cancelled(cancel_event)
+    separator.update_parameter(segment=params["segment"], overlap=params["overlap"], shifts=params["shifts"],
+                               callback=cancellable_callback(cancel_event, throttle, on_segment))
+    try:
+        with th.inference_mode(), profiling.span("inference", model=model_name, frames=wav.shape[-1]):
+            origin, res = separator.separate_tensor(wav, separator.samplerate)
+    except KeyboardInterrupt:
+        raise JobCancelled(track)
+    if one_stem is not None:
+        # only the requested stem and its complement are kept
+        res = one_stem_result(origin, res, one_stem, other_method)
+    if store_result and cache_key is not None:
+        stem_cache.store(cache_key, origin, res, separator.samplerate)
     result_list.append(origin)
     result_list.append(res)
     result_list.append(separator.samplerate)
     sr = separator.samplerate
-    del separator
     return origin, res, sr
@@ -0,0 +1,95 @@
+import bisect
+import re
+
+# The library is held as parallel name and path lists with a name -> index map,
+# so the player's index arithmetic never copies the playlist. SearchIndex
+# filters it as you type: every query word must appear in the song name, and
+# songs where it starts a word come first. Word prefixes are found by bisecting
+# a sorted word list; other substrings by str.find over one joined string of
+# all names. A query that extends the previous one only filters its results.
+WORD = re.compile(r"\w+")
+
+class Playlist:
+    def __init__(self, songs=None):
+        self.names = []
+        self.paths = []
+        self.positions = dict()
+        self.extend(songs or {})
+
+    def extend(self, songs):
+        # songs: {name: path}; a name already listed keeps its place
+        for name, path in songs.items():
+            if name in self.positions:
+                self.paths[self.positions[name]] = path
+                continue
+            self.positions[name] = len(self.names)
+            self.names.append(name)
+            self.paths.append(path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def index(self, name):
+        return self.positions[name]
+
+    def name(self, index):
+        return self.names[index % len(self.names)]
+
+    def path(self, index):
+        return self.paths[index % len(self.paths)]
+
+    def get(self, name, default=None):
+        index = self.positions.get(name)
+        return default if index is None else self.paths[index]
+
+class SearchIndex:
+    def __init__(self, names):
+        self.names = [name.lower() for name in names]
+        self.words = sorted((word, n) for n, name in enumerate(self.names) for word in WORD.findall(name))
+        self.keys = [word for word, _ in self.words]
+        # one string of every name; `starts` maps its offsets back to songs
+        self.text = "\n".join(self.names)
+        self.starts = []
+        offset = 0
+        for name in self.names:
+            self.starts.append(offset)
+            offset += len(name) + 1
+        self.last = ("", None)
+
+    def prefix(self, word):
+        # songs with a word starting with `word`
+        first = bisect.bisect_left(self.keys, word)
+        last = bisect.bisect_left(self.keys, word + "\uffff", first)
+        return {n for _, n in self.words[first:last]}
+
+    def substring(self, word, within=None):
+        # songs whose name contains `word`
+        if within is not None:
+            return {n for n in within if word in self.names[n]}
+        found = set()
+        start = self.text.find(word)
+        while start != -1:
+            n = bisect.bisect_right(self.starts, start) - 1
+            found.add(n)
+            # continue after this name
+            start = self.text.find(word, self.starts[n] + len(self.names[n]) + 1)
+        return found
+
+    def search(self, text):
+        # song indices matching every word of `text`, best matches first
+        words = text.lower().split()
+        if not words:
+            return list(range(len(self.names)))
+        previous, results = self.last
+        within = set(results) if results is not None and previous and text.lower().startswith(previous) else None
+        matches = None
+        for word in words:
+            found = self.substring(word, matches if matches is not None else within)
+            matches = found if matches is None else matches & found
+        prefixed = self.prefix(words[0])
+        ranked = sorted(matches, key=lambda n: (n not in prefixed, n))
+        self.last = (text.lower(), ranked)
+        return ranked
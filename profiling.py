@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Timing spans and counters for the split pipeline. Events are kept in a
+# bounded in-memory buffer (exportable as JSON lines) and, if
+# SOURCE_STREAM_TRACE names a file, also appended to it as they happen.
+TRACE_PATH = os.environ.get("SOURCE_STREAM_TRACE")
+MAX_EVENTS = 20000
+
+trace_lock = threading.Lock()
+events = deque(maxlen=MAX_EVENTS)
+span_stats = dict()
+counters = dict()
+
+def record(event):
+    with trace_lock:
+        events.append(event)
+        if TRACE_PATH:
+            with open(TRACE_PATH, "a") as f:
+                f.write(json.dumps(event, default=str) + "\n")
+
+@contextmanager
+def span(name, **fields):
+    ts = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, time.perf_counter() - start, ts, **fields)
+
+def add_span(name, duration, ts=None, **fields):
+    with trace_lock:
+        stat = span_stats.setdefault(name, {"count": 0, "total_s": 0., "max_s": 0.})
+        stat["count"] += 1
+        stat["total_s"] += duration
+        stat["max_s"] = max(stat["max_s"], duration)
+    record({
+        "type": "span",
+        "name": name,
+        "ts": time.time() - duration if ts is None else ts,
+        "duration_s": duration,
+        "thread": threading.current_thread().name,
+        **fields,
+    })
+
+def count(name, n=1, **fields):
+    with trace_lock:
+        counters[name] = counters.get(name, 0) + n
+    record({"type": "counter", "name": name, "ts": time.time(), "value": n, **fields})
+
+def stats():
+    with trace_lock:
+        return {
+            "spans": {name: dict(stat) for name, stat in span_stats.items()},
+            "counters": dict(counters),
+        }
+
+def export_trace(path):
+    with trace_lock:
+        snapshot = list(events)
+    with open(path, "w") as f:
+        for event in snapshot:
+            f.write(json.dumps(event, default=str) + "\n")
+    return len(snapshot)
+
+def reset():
+    with trace_lock:
+        events.clear()
+        span_stats.clear()
+        counters.clear()
+
+def segment_callback():
+    # Separator callback that turns the per-segment start/end notifications
+    # into "inference_segment" spans
+    started = dict()
+
+    def callback(info):
+        key = (info["model_idx_in_bag"], info["shift_idx"], info["segment_offset"])
+        if info["state"] == "start":
+            started[key] = time.perf_counter()
+        elif key in started:
+            add_span("inference_segment", time.perf_counter() - started.pop(key),
+                     model_idx=info["model_idx_in_bag"], segment_offset=info["segment_offset"])
+
+    return callback
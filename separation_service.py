@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from jobs import JobScheduler, QueueFull, PRIORITY_CURRENT
+from library_scan import AUDIO_EXTENSIONS
+from library_store import LibraryStore
+from stem_store import is_stem_file
+
+# A local separation service: one process keeps the Demucs models warm and runs
+# split and export jobs for every player and batch script on the machine.
+# Identical requests that are still queued or running share one job. Progress
+# events are streamed back as JSON lines over localhost HTTP:
+#
+#   POST   /jobs                {"kind", "params", "priority"} -> {"id", "deduplicated"}
+#   GET    /jobs/<id>           job status, with the stem paths once done
+#   GET    /jobs/<id>/events    JSON lines, one per event, until the job ends
+#   DELETE /jobs/<id>           cancel
+#   GET    /status              loaded models and unfinished jobs
+#
+# LocalClient talks to a SeparationService in the same process, for tests.
+# Request parameters end up in file paths, so they are checked before a job is
+# queued, and POST bodies must be JSON so that web pages can't send jobs.
+DEFAULT_PORT = 8765
+DB_PATH = os.path.join("data", "service.db")
+KEEP_FINISHED = 256
+KEEPALIVE = 15
+EXTS = ("mp3", "wav", "flac", "stems")
+
+class BadRequest(ValueError):
+    pass
+
+class SeparationService:
+    def __init__(self, store_path=DB_PATH, device_limits=None, max_queue=64, model=None):
+        # `model` stands in for the model module, e.g. a stub in tests
+        if model is None:
+            import model
+        self.model = model
+        self.lock = threading.Condition()
+        self.events = dict()
+        self.finished = OrderedDict()
+        self.inflight = dict()
+        kwargs = {} if device_limits is None else {"device_limits": device_limits}
+        self.scheduler = JobScheduler(
+            {"split": self.run_split, "export": self.run_export},
+            store=LibraryStore(store_path) if store_path else None,
+            max_queue=max_queue,
+            **kwargs,
+        )
+
+    def start(self, preload=()):
+        for model_name in preload:
+            self.model.get_separator(model_name)
+        # interrupted jobs are queued again before the workers start
+        for job in self.scheduler.resume(on_done=self.job_done):
+            self.track(job)
+        self.scheduler.start()
+        return self
+
+    def stop(self):
+        self.scheduler.stop()
+
+    #------------- Jobs -------------#
+
+    def request_key(self, kind, params):
+        return kind + ":" + json.dumps(params, sort_keys=True)
+
+    def track(self, job):
+        with self.lock:
+            self.events.setdefault(job.id, [])
+            self.inflight[self.request_key(job.kind, job.params)] = job.id
+
+    def check(self, kind, params):
+        if kind not in ("split", "export"):
+            raise BadRequest(f"unknown job kind {kind}")
+        if not isinstance(params, dict):
+            raise BadRequest("params must be an object")
+        if params.get("model") not in self.model.MODELS:
+            raise BadRequest(f"model must be one of {', '.join(self.model.MODELS)}")
+        if params.get("ext", "mp3") not in EXTS:
+            raise BadRequest(f"ext must be one of {', '.join(EXTS)}")
+        name = params.get("name")
+        if kind == "export" or name is not None:
+            if not isinstance(name, str) or not name or ".." in name or "/" in name or "\\" in name or os.sep in name:
+                raise BadRequest(f"invalid name {name!r}")
+        if kind == "split":
+            track = params.get("track")
+            if not isinstance(track, str) or not track.lower().endswith(AUDIO_EXTENSIONS) or not os.path.isfile(track):
+                raise BadRequest(f"no audio file at {track!r}")
+            if params.get("quality", self.model.DEFAULT_QUALITY) not in self.model.QUALITY_PRESETS:
+                raise BadRequest(f"unknown quality {params.get('quality')!r}")
+            if params.get("other_method", "add") not in ("add", "minus", "none"):
+                raise BadRequest(f"unknown other_method {params.get('other_method')!r}")
+            if params.get("one_stem") is not None and not isinstance(params["one_stem"], str):
+                raise BadRequest("one_stem must be a stem name")
+        else:
+            path = params.get("path")
+            if not isinstance(path, str) or not is_stem_file(path) or not os.path.isfile(path):
+                raise BadRequest(f"no stem file at {path!r}")
+
+    def submit(self, kind, params, priority=PRIORITY_CURRENT):
+        # raises BadRequest for invalid parameters
+        self.check(kind, params)
+        key = self.request_key(kind, params)
+        with self.lock:
+            if key in self.inflight:
+                return {"id": self.inflight[key], "deduplicated": True}
+            device = "encode" if kind == "export" else self.model.get_device()
+            job = self.scheduler.submit(kind, params, priority=priority, device=device, on_done=self.job_done)
+            self.track(job)
+        self.emit(job, "queued")
+        return {"id": job.id, "deduplicated": False}
+
+    def emit(self, job, event, **fields):
+        with self.lock:
+            self.events.setdefault(job.id, []).append(dict(fields, event=event, ts=time.time()))
+            self.lock.notify_all()
+
+    def job_done(self, job):
+        self.emit(job, job.state, error=job.error)
+        with self.lock:
+            self.inflight.pop(self.request_key(job.kind, job.params), None)
+            self.finished[job.id] = self.describe(job)
+            while len(self.finished) > KEEP_FINISHED:
+                old_id, _ = self.finished.popitem(last=False)
+                self.events.pop(old_id, None)
+            self.lock.notify_all()
+
+    def describe(self, job):
+        return {
+            "id": job.id,
+            "kind": job.kind,
+            "params": job.params,
+            "state": job.state,
+            "error": job.error,
+            "result": job.result,
+            "elapsed": job.elapsed,
+        }
+
+    def status(self, job_id):
+        with self.lock:
+            if job_id in self.finished:
+                return self.finished[job_id]
+        for job in self.scheduler.pending():
+            if job.id == job_id:
+                return self.describe(job)
+        return None
+
+    def cancel(self, job_id):
+        return self.scheduler.cancel(job_id)
+
+    def wait_events(self, job_id, since=0, timeout=None):
+        # events after the first `since`, waiting up to `timeout` for new ones;
+        # returns (events, finished)
+        with self.lock:
+            self.lock.wait_for(
+                lambda: len(self.events.get(job_id, [])) > since or job_id in self.finished or job_id not in self.events,
+                timeout,
+            )
+            return self.events.get(job_id, [])[since:], job_id in self.finished or job_id not in self.events
+
+    def info(self):
+        with self.model.model_cache_lock:
+            models = [{"model": name, "device": device, "quantized": quantized}
+                      for name, device, quantized in self.model.MODEL_CACHE]
+        return {"models": models, "jobs": [self.describe(job) for job in self.scheduler.pending()]}
+
+    #------------- Handlers -------------#
+
+    def run_split(self, job):
+        params = job.params
+        model_name, track = params["model"], params["track"]
+        quality = params.get("quality", self.model.DEFAULT_QUALITY)
+        one_stem = params.get("one_stem")
+        other_method = params.get("other_method", "add")
+
+        def on_segment(info):
+            self.emit(job, "segment", offset=info.get("segment_offset"), length=info.get("audio_length"),
+                      shift=info.get("shift_idx"), model_index=info.get("model_idx_in_bag"))
+
+        separated = self.model.separate([], model_name, track, one_stem=one_stem, other_method=other_method,
+                                        cancel_event=job.cancel_event, store_result=params.get("cache", True),
+                                        quality=quality, on_segment=on_segment)
+        if separated is None:
+            raise RuntimeError(f"could not separate {track}")
+        origin, stems, samplerate = separated
+        self.emit(job, "separated")
+        name = params.get("name") or os.path.basename(track)
+        separation = dict(self.model.separation_params(model_name, quality), one_stem=one_stem)
+        paths = self.model.save_stems(origin, stems, name, model_name, samplerate, [], ext=params.get("ext", "mp3"),
+                                      progress=lambda stem, done, total: self.emit(job, "saved", stem=stem, done=done, total=total),
+                                      cancel_event=job.cancel_event, separation=separation)[0]
+        # clients may run from another working directory
+        return {stem: os.path.abspath(path) for stem, path in paths.items()}
+
+    def run_export(self, job):
+        params = job.params
+        paths = self.model.export_stem_file(params["path"], params["model"], params["name"], [], ext=params.get("ext", "mp3"),
+                                            progress=lambda stem, done, total: self.emit(job, "saved", stem=stem, done=done, total=total))[0]
+        return {stem: os.path.abspath(path) for stem, path in paths.items()}
+
+#------------- HTTP -------------#
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def job_path(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        return parts[1] if len(parts) > 1 and parts[0] == "jobs" else None, parts[2:]
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/status":
+            return self.send_json(self.service.info())
+        job_id, rest = self.job_path()
+        if job_id is None:
+            return self.send_json({"error": "not found"}, 404)
+        if rest == ["events"]:
+            return self.stream_events(job_id)
+        status = self.service.status(job_id)
+        if status is None:
+            return self.send_json({"error": f"no job {job_id}"}, 404)
+        self.send_json(status)
+
+    def stream_events(self, job_id):
+        query = parse_qs(urlparse(self.path).query)
+        since = int(query.get("since", ["0"])[0])
+        # clients that poll for their own cancellation ask for keepalives sooner
+        interval = min(max(float(query.get("keepalive", [KEEPALIVE])[0]), 0.1), KEEPALIVE)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        finished = False
+        while not finished:
+            events, finished = self.service.wait_events(job_id, since, timeout=interval)
+            since += len(events)
+            # a keepalive line on each quiet timeout notices closed clients
+            events = events or [{"event": "keepalive", "ts": time.time()}]
+            try:
+                for event in events:
+                    self.wfile.write((json.dumps(event, default=str) + "\n").encode())
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/jobs":
+            return self.send_json({"error": "not found"}, 404)
+        # browsers can send text/plain and form posts to any origin, but not JSON
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            return self.send_json({"error": "Content-Type must be application/json"}, 415)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            priority = int(request.get("priority", PRIORITY_CURRENT))
+            self.send_json(self.service.submit(request.get("kind"), request.get("params", {}), priority))
+        except (BadRequest, ValueError, TypeError, AttributeError) as error:
+            self.send_json({"error": str(error)}, 400)
+        except QueueFull as error:
+            self.send_json({"error": str(error)}, 503)
+
+    def do_DELETE(self):
+        job_id, _ = self.job_path()
+        self.send_json({"cancelled": bool(job_id and self.service.cancel(job_id))})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(service, host="127.0.0.1", port=DEFAULT_PORT):
+    handler = type("BoundServiceHandler", (ServiceHandler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+#------------- Clients -------------#
+
+class ServiceClient:
+    def __init__(self, url=f"http://127.0.0.1:{DEFAULT_PORT}", timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def submit(self, kind, params, priority=PRIORITY_CURRENT):
+        return self.request("POST", "/jobs", {"kind": kind, "params": params, "priority": priority})
+
+    def status(self, job_id):
+        return self.request("GET", f"/jobs/{job_id}")
+
+    def cancel(self, job_id):
+        return self.request("DELETE", f"/jobs/{job_id}")["cancelled"]
+
+    def info(self):
+        return self.request("GET", "/status")
+
+    def events(self, job_id, since=0, keepalive=None):
+        # with `keepalive` (seconds) keepalive events are yielded too, at least
+        # that often, so a caller can check for cancellation while a job is
+        # queued or quiet; closing the generator closes the stream
+        query = f"since={since}" + (f"&keepalive={keepalive}" if keepalive is not None else "")
+        with urllib.request.urlopen(f"{self.url}/jobs/{job_id}/events?{query}", timeout=max(self.timeout, KEEPALIVE)) as response:
+            for line in response:
+                event = json.loads(line)
+                if event["event"] != "keepalive" or keepalive is not None:
+                    yield event
+
+    def wait(self, job_id):
+        for _ in self.events(job_id):
+            pass
+        return self.status(job_id)
+
+class LocalClient:
+    # same interface as ServiceClient, calling the service directly
+    def __init__(self, service):
+        self.service = service
+
+    def submit(self, kind, params, priority=PRIORITY_CURRENT):
+        return self.service.submit(kind, params, priority)
+
+    def status(self, job_id):
+        return self.service.status(job_id)
+
+    def cancel(self, job_id):
+        return self.service.cancel(job_id)
+
+    def info(self):
+        return self.service.info()
+
+    def events(self, job_id, since=0, keepalive=None):
+        finished = False
+        while not finished:
+            events, finished = self.service.wait_events(job_id, since, timeout=keepalive or KEEPALIVE)
+            since += len(events)
+            if not events and keepalive is not None:
+                events = [{"event": "keepalive", "ts": time.time()}]
+            yield from events
+
+    def wait(self, job_id):
+        for _ in self.events(job_id):
+            pass
+        return self.status(job_id)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the local separation service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--preload", nargs="*", default=["htdemucs"], choices=["htdemucs", "htdemucs_ft", "htdemucs_6s"], help="Models to load at startup")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads for CPU separation")
+    parser.add_argument("--interop-threads", type=int, default=None)
+    parser.add_argument("--quantize", action="store_true", help="Run CPU separation with int8 dynamically quantized linear layers")
+    args = parser.parse_args()
+
+    service = SeparationService()
+    service.model.configure_cpu(args.threads, args.interop_threads, args.quantize)
+    service.start(preload=args.preload)
+    server = serve(service, args.host, args.port)
+    print(f"Separation service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import threading
+
+import torch as th
+
+import profiling
+
+# Separation results are stored under data/stem_cache, one file per
+# (audio content, model, separation parameters). Least recently used entries
+# are removed once the cache grows over the budget. Reduced-precision tensors
+# (model.PackedTensor) are written as they are held and come back as float32.
+CACHE_DIR = os.path.join("data", "stem_cache")
+CACHE_BUDGET = int(os.environ.get("SOURCE_STREAM_STEM_CACHE_MB", 4096)) * 2**20
+CHUNK_SIZE = 2**20
+
+cache_lock = threading.Lock()
+file_hashes = dict()
+
+def file_hash(path):
+    stat = os.stat(path)
+    sig = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if sig in file_hashes:
+        return file_hashes[sig]
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    file_hashes[sig] = digest.hexdigest()
+    return file_hashes[sig]
+
+def track_key(track, model_name, **params):
+    params = json.dumps(params, sort_keys=True, default=str)
+    key = f"{file_hash(track)}:{model_name}:{params}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.pt")
+
+def contains(key):
+    return os.path.isfile(cache_path(key))
+
+def lookup(key):
+    path = cache_path(key)
+    if not os.path.isfile(path):
+        profiling.count("stem_cache_miss")
+        return None
+    try:
+        with profiling.span("stem_cache_load", key=key):
+            entry = th.load(path)
+    except (OSError, RuntimeError, EOFError):
+        profiling.count("stem_cache_miss")
+        return None
+    profiling.count("stem_cache_hit")
+    os.utime(path)
+    stems = {name: loaded(stem) for name, stem in entry["stems"].items()}
+    return loaded(entry["origin"]), stems, entry["samplerate"]
+
+def stored(tensor):
+    if hasattr(tensor, "unpack"):
+        return {"data": tensor.data, "scale": tensor.scale}
+    return tensor
+
+def loaded(value):
+    if isinstance(value, dict):
+        return value["data"].to(th.float32) * value["scale"]
+    return value
+
+def store(key, origin, stems, samplerate):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(key)
+    tmp_path = path + ".tmp"
+    # packed stems are stored without converting them back to float32
+    stems = getattr(stems, "packed", stems)
+    entry = {
+        "origin": stored(origin),
+        "stems": {name: stored(stem) for name, stem in stems.items()},
+        "samplerate": samplerate,
+    }
+    with cache_lock:
+        th.save(entry, tmp_path)
+        os.replace(tmp_path, path)
+        profiling.count("bytes_written", os.path.getsize(path), path=path)
+        evict()
+
+def evict(budget=None):
+    budget = CACHE_BUDGET if budget is None else budget
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".pt"):
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= budget:
+            break
+        os.remove(os.path.join(CACHE_DIR, name))
+        total -= size
+
+def clear():
+    with cache_lock:
+        if os.path.isdir(CACHE_DIR):
+            evict(budget=0)
@@ -0,0 +1,101 @@
+import threading
+
+import numpy as np
+
+# Stems are held as one int16 array of shape (stems, channels, frames) and
+# mixed block by block with per-stem gains into a single interleaved int16
+# stream, so every stem always plays from the same frame.
+PCM_SCALE = 1 / 32768
+
+class StemMixer:
+    def __init__(self, names, length, channels=2, samplerate=44100, gain=1.0, audio=None, scales=None):
+        # `audio` can be an existing (stems, channels, frames) int16 array,
+        # e.g. a memory-mapped or packed stem file, which is then played in place;
+        # `scales` are the per-stem values of one int16 step (default 1 / 32768)
+        self.names = list(names)
+        self.index = {name: n for n, name in enumerate(self.names)}
+        self.samplerate = samplerate
+        preloaded = audio is not None
+        if not preloaded:
+            audio = np.zeros((len(self.names), channels, length), dtype=np.int16)
+        self.audio = audio
+        self.scales = np.full(len(self.names), PCM_SCALE, dtype=np.float32)
+        if scales is not None:
+            self.scales[:] = scales
+        self.gains = np.full(len(self.names), gain, dtype=np.float32)
+        self.muted = np.zeros(len(self.names), dtype=bool)
+        self.soloed = np.zeros(len(self.names), dtype=bool)
+        self.ready = self.length if preloaded else 0
+        self.position = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(cls, stems, samplerate, gain=1.0):
+        # stems: {name: int16 array of shape (channels, frames)}
+        length = min(pcm.shape[-1] for pcm in stems.values())
+        channels = next(iter(stems.values())).shape[0]
+        engine = cls(stems.keys(), length, channels, samplerate, gain)
+        engine.write(0, stems)
+        return engine
+
+    @property
+    def length(self):
+        return self.audio.shape[-1]
+
+    @property
+    def channels(self):
+        return self.audio.shape[1]
+
+    @property
+    def complete(self):
+        return self.ready >= self.length
+
+    def seconds(self, frames):
+        return frames / self.samplerate
+
+    def write(self, offset, stems):
+        # fills [offset, offset + frames) for every stem, used while streaming
+        frames = 0
+        for name, pcm in stems.items():
+            frames = max(min(pcm.shape[-1], self.length - offset), 0)
+            self.audio[self.index[name], :, offset:offset + frames] = pcm[..., :frames]
+        with self.lock:
+            self.ready = max(self.ready, offset + frames)
+
+    def set_gain(self, name, gain):
+        self.gains[self.index[name]] = gain
+
+    def set_muted(self, name, muted):
+        self.muted[self.index[name]] = muted
+
+    def set_soloed(self, name, soloed):
+        self.soloed[self.index[name]] = soloed
+
+    def is_muted(self, name):
+        return bool(self.muted[self.index[name]])
+
+    def is_soloed(self, name):
+        return bool(self.soloed[self.index[name]])
+
+    def effective_gains(self):
+        gains = np.where(self.muted, 0., self.gains)
+        if self.soloed.any():
+            gains = np.where(self.soloed, gains, 0.)
+        return (gains * self.scales).astype(np.float32)
+
+    def seek(self, frame):
+        with self.lock:
+            self.position = int(min(max(frame, 0), self.length))
+
+    def mix(self, frames):
+        # returns the next block as interleaved int16 (frames, channels), or
+        # None if nothing is ready yet (end of the stems or waiting on a stream)
+        with self.lock:
+            start = self.position
+            end = min(start + frames, self.ready)
+            if end <= start:
+                return None
+            self.position = end
+        block = np.tensordot(self.effective_gains(), self.audio[:, :, start:end], axes=1)
+        np.clip(block, -1., 1., out=block)
+        return np.ascontiguousarray((block * 32767).astype(np.int16).T)
@@ -0,0 +1,250 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Raw stem files hold every stem of a track as planar int16 PCM
+# (stems, channels, frames) behind a small JSON header, so they can be opened
+# with numpy.memmap and only the pages being played are read from disk.
+#
+#   8 bytes   magic
+#   4 bytes   header length (little endian uint32)
+#   n bytes   JSON header
+#   padding   up to DATA_ALIGN
+#   data      int16 samples
+#
+# Packed stem files (the default) are lossless and about half the size. The
+# audio is cut into blocks of BLOCK_FRAMES frames; each block of each stem is
+# delta coded per channel, split into low and high byte planes and zlib
+# compressed. A seek index after the header gives every block's position, so
+# any time range of any stems is read by decompressing only the blocks it
+# touches, in parallel.
+#
+#   8 bytes   magic
+#   4 bytes   header length (little endian uint32)
+#   n bytes   JSON header
+#   index     uint64 (blocks, stems, 2): offset from the data start, length
+#   data      compressed blocks, block by block, stems in header order
+MAGIC = b"SSTEMS01"
+PACKED_MAGIC = b"SSTEMZ01"
+DATA_ALIGN = 4096
+EXT = "stems"
+BLOCK_FRAMES = 65536
+LEVEL = 1
+CACHE_BLOCKS = 64
+DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+def write_stem_file(path, stems, samplerate, metadata=None, packed=True):
+    # stems: {name: int16 array of shape (channels, frames)}
+    if packed:
+        return write_packed_stem_file(path, stems, samplerate, metadata)
+    names = list(stems.keys())
+    channels, frames = next(iter(stems.values())).shape
+    header = {
+        "samplerate": samplerate,
+        "channels": channels,
+        "frames": frames,
+        "dtype": "int16",
+        "stems": names,
+        "metadata": metadata or {},
+    }
+    encoded = json.dumps(header).encode()
+    data_offset = -(-(len(MAGIC) + 4 + len(encoded)) // DATA_ALIGN) * DATA_ALIGN
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(encoded)))
+        f.write(encoded)
+        f.write(b"\0" * (data_offset - f.tell()))
+        for name in names:
+            pcm = np.ascontiguousarray(stems[name][:, :frames], dtype="<i2")
+            f.write(pcm.tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+def encode_block(pcm):
+    # (channels, frames) int16 -> compressed bytes; the deltas wrap around in
+    # int16 and the cumulative sum in decode_block wraps back
+    deltas = np.diff(pcm.astype("<i2"), axis=-1, prepend=np.zeros((pcm.shape[0], 1), dtype="<i2"))
+    planes = deltas.view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(np.ascontiguousarray(planes).tobytes(), LEVEL)
+
+def decode_block(data, channels):
+    planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(2, -1)
+    deltas = np.ascontiguousarray(planes.T).view("<i2").reshape(channels, -1)
+    return np.cumsum(deltas, axis=-1, dtype=np.int16)
+
+def write_packed_stem_file(path, stems, samplerate, metadata=None, block_frames=BLOCK_FRAMES, workers=None):
+    names = list(stems.keys())
+    channels, frames = next(iter(stems.values())).shape
+    blocks = -(-frames // block_frames)
+    with ThreadPoolExecutor(max_workers=workers or DECODE_WORKERS) as pool:
+        # zlib releases the GIL, so blocks compress in parallel
+        encoded = list(pool.map(
+            lambda item: encode_block(stems[item[1]][:, item[0] * block_frames:min((item[0] + 1) * block_frames, frames)]),
+            [(block, name) for block in range(blocks) for name in names],
+        ))
+    index = np.zeros((blocks, len(names), 2), dtype="<u8")
+    index[..., 1] = np.array([len(data) for data in encoded], dtype="<u8").reshape(blocks, len(names))
+    index[..., 0] = (np.cumsum(index[..., 1]) - index[..., 1].ravel()).reshape(blocks, len(names))
+    header = {
+        "samplerate": samplerate,
+        "channels": channels,
+        "frames": frames,
+        "dtype": "int16",
+        "stems": names,
+        "metadata": metadata or {},
+        "codec": "zlib-delta16",
+        "block_frames": block_frames,
+        "blocks": blocks,
+    }
+    encoded_header = json.dumps(header).encode()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PACKED_MAGIC)
+        f.write(struct.pack("<I", len(encoded_header)))
+        f.write(encoded_header)
+        f.write(index.tobytes())
+        for data in encoded:
+            f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+def read_header(f):
+    magic = f.read(len(MAGIC))
+    if magic not in (MAGIC, PACKED_MAGIC):
+        raise ValueError(f"{f.name} is not a stem file")
+    size, = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(size))
+    header["packed"] = magic == PACKED_MAGIC
+    if header["packed"]:
+        shape = (header["blocks"], len(header["stems"]), 2)
+        header["index"] = np.frombuffer(f.read(8 * int(np.prod(shape))), dtype="<u8").reshape(shape)
+        header["data_offset"] = len(MAGIC) + 4 + size + header["index"].nbytes
+    else:
+        header["data_offset"] = -(-(len(MAGIC) + 4 + size) // DATA_ALIGN) * DATA_ALIGN
+    return header
+
+def open_stem_file(path):
+    # (header, audio) where audio indexes like a (stems, channels, frames)
+    # int16 array: a memmap for raw files, a PackedStemAudio for packed ones
+    with open(path, "rb") as f:
+        header = read_header(f)
+    if header["packed"]:
+        return header, PackedStemAudio(path, header)
+    shape = (len(header["stems"]), header["channels"], header["frames"])
+    audio = np.memmap(path, dtype="<i2", mode="r", offset=header["data_offset"], shape=shape)
+    return header, audio
+
+class PackedStemAudio:
+    # Read-only (stems, channels, frames) view of a packed stem file. Slicing
+    # decompresses the blocks the slice touches, in parallel, and keeps the
+    # last CACHE_BLOCKS decoded blocks so playback decodes each block once.
+    pool = None
+    pool_lock = threading.Lock()
+    dtype = np.dtype(np.int16)
+    ndim = 3
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.block_frames = header["block_frames"]
+        self.index = header["index"]
+        self.data_offset = header["data_offset"]
+        self.shape = (len(header["stems"]), header["channels"], header["frames"])
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    @classmethod
+    def decode_pool(cls):
+        with cls.pool_lock:
+            if cls.pool is None:
+                cls.pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="stem_decode")
+            return cls.pool
+
+    def block(self, block, stem):
+        key = (block, stem)
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        offset, length = (int(value) for value in self.index[block, stem])
+        start = self.data_offset + offset
+        pcm = decode_block(self.map[start:start + length], self.shape[1])
+        with self.cache_lock:
+            self.cache[key] = pcm
+            while len(self.cache) > CACHE_BLOCKS:
+                self.cache.popitem(last=False)
+        return pcm
+
+    def read(self, start=0, end=None, stems=None):
+        # int16 array (len(stems), channels, end - start); `stems` are stem
+        # indices, all stems by default
+        end = self.shape[2] if end is None else min(end, self.shape[2])
+        start = min(max(start, 0), end)
+        stems = range(self.shape[0]) if stems is None else stems
+        out = np.empty((len(stems), self.shape[1], end - start), dtype=np.int16)
+        if end == start:
+            return out
+        first, last = start // self.block_frames, (end - 1) // self.block_frames
+        jobs = [(block, n, stem) for block in range(first, last + 1) for n, stem in enumerate(stems)]
+        if len(jobs) > 1:
+            decoded = list(self.decode_pool().map(lambda job: self.block(job[0], job[2]), jobs))
+        else:
+            decoded = [self.block(jobs[0][0], jobs[0][2])]
+        for (block, n, _), pcm in zip(jobs, decoded):
+            block_start = block * self.block_frames
+            lo, hi = max(start, block_start), min(end, block_start + pcm.shape[-1])
+            out[n, :, lo - start:hi - start] = pcm[:, lo - block_start:hi - block_start]
+        return out
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for stem in range(self.shape[0]):
+            yield self[stem]
+
+    def __array__(self, dtype=None, copy=None):
+        audio = self.read()
+        return audio if dtype is None else audio.astype(dtype)
+
+    def __getitem__(self, key):
+        # supports integer and slice keys on each axis
+        key = key if isinstance(key, tuple) else (key,)
+        stem_key, channel_key, frame_key = key + (slice(None),) * (3 - len(key))
+        stems = range(self.shape[0])[stem_key]
+        stems = [stems] if isinstance(stems, int) else list(stems)
+        frames = range(self.shape[2])[frame_key]
+        if isinstance(frames, int):
+            audio = self.read(frames, frames + 1, stems)[..., 0]
+        elif frames.step == 1:
+            audio = self.read(frames.start, max(frames.stop, frames.start), stems)
+        else:
+            audio = self.read(0, self.shape[2], stems)[..., frame_key]
+        stem_axis = 0 if isinstance(stem_key, (int, np.integer)) else slice(None)
+        return audio[stem_axis, channel_key]
+
+def resample(audio, from_samplerate, to_samplerate):
+    # linear resampling into memory, only used when the mixer runs at a
+    # different rate than the file was written at
+    frames = audio.shape[-1]
+    target = int(frames * to_samplerate / from_samplerate)
+    positions = np.linspace(0, frames - 1, target)
+    out = np.empty(audio.shape[:-1] + (target,), dtype=np.int16)
+    for index in np.ndindex(audio.shape[:-1]):
+        out[index] = np.interp(positions, np.arange(frames), audio[index]).astype(np.int16)
+    return out
+
+def is_stem_file(path):
+    return str(path).endswith("." + EXT)
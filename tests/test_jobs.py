@@ -0,0 +1,56 @@
+import threading
+
+from jobs import JobCancelled, JobScheduler, PRIORITY_CURRENT, PRIORITY_PREFETCH, PRIORITY_SAVE
+from library_store import LibraryStore
+
+def test_jobs_run_in_priority_order():
+    order = []
+    scheduler = JobScheduler({"work": lambda job: order.append(job.params["n"])}, workers=1)
+    jobs = [
+        scheduler.submit("work", {"n": 0}, priority=PRIORITY_PREFETCH),
+        scheduler.submit("work", {"n": 1}, priority=PRIORITY_SAVE),
+        scheduler.submit("work", {"n": 2}, priority=PRIORITY_CURRENT),
+        scheduler.submit("work", {"n": 3}, priority=PRIORITY_SAVE),
+    ]
+    scheduler.start()
+    for job in jobs:
+        assert job.done_event.wait(5)
+    assert order == [2, 1, 3, 0]
+    scheduler.stop()
+
+def test_failures_and_cancellation_are_reported():
+    def fail(job):
+        raise ValueError("bad input")
+
+    def wait_for_cancel(job):
+        job.cancel_event.wait(5)
+        job.check_cancelled()
+
+    scheduler = JobScheduler({"fail": fail, "wait": wait_for_cancel}).start()
+    failed = scheduler.submit("fail", {})
+    failed.wait(5)
+    assert (failed.state, failed.error) == ("failed", "ValueError: bad input")
+    waiting = scheduler.submit("wait", {})
+    scheduler.cancel(waiting.id)
+    assert waiting.done_event.wait(5)
+    assert waiting.state == "cancelled"
+    scheduler.stop()
+
+def test_failing_callback_keeps_the_worker():
+    def callback(job):
+        raise RuntimeError("callback failed")
+
+    scheduler = JobScheduler({"work": lambda job: job.params["n"]}, workers=1).start()
+    scheduler.submit("work", {"n": 1}, on_done=callback).wait(5)
+    assert scheduler.submit("work", {"n": 2}).wait(5) == 2
+    assert scheduler.threads[0].is_alive()
+    scheduler.stop()
+
+def test_unfinished_jobs_resume(tmp_path):
+    store = LibraryStore(str(tmp_path / "jobs.db"))
+    scheduler = JobScheduler({"work": lambda job: job.params["n"]}, store=store)
+    queued = scheduler.submit("work", {"n": 1})
+    scheduler.submit("work", {"n": 2}, persistent=False)
+    resumed = JobScheduler({"work": lambda job: job.params["n"]}, store=store).resume()
+    assert [(job.id, job.params) for job in resumed] == [(queued.id, {"n": 1})]
+    store.close()
@@ -0,0 +1,34 @@
+from playlist import Playlist, SearchIndex
+
+NAMES = ["Blue Monday.mp3", "Blackbird.flac", "Love Will Tear Us Apart.mp3", "Monday Blues.wav", "Sunday Morning.mp3"]
+
+def test_search_matches_every_word():
+    index = SearchIndex(NAMES)
+    assert index.search("mon blue") == [0, 3]
+    assert index.search("") == list(range(len(NAMES)))
+    assert index.search("xyz") == []
+
+def test_word_prefixes_rank_first():
+    index = SearchIndex(NAMES)
+    # "day" is inside "monday" and "sunday" but starts no word
+    assert sorted(index.search("day")) == [0, 3, 4]
+    # "bl" starts a word in 0, 1 and 3
+    assert index.search("bl") == [0, 1, 3]
+    assert index.search("lue") == [0, 3]
+    # the extension is a word too
+    assert index.search("mp") == [0, 2, 4]
+
+def test_extended_query_narrows_previous_results():
+    index = SearchIndex(NAMES)
+    assert index.search("m") == [0, 2, 3, 4]
+    assert index.search("mo") == [0, 3, 4]
+    assert index.search("mor") == [4]
+    # a query that does not extend the last one searches everything again
+    assert index.search("love") == [2]
+
+def test_playlist_keeps_places():
+    playlist = Playlist({"a": "/a.mp3", "b": "/b.mp3"})
+    playlist.extend({"c": "/c.mp3", "a": "/new/a.mp3"})
+    assert playlist.names == ["a", "b", "c"]
+    assert playlist.get("a") == "/new/a.mp3"
+    assert playlist.name(4) == "b"
@@ -0,0 +1,84 @@
+import os
+import threading
+import types
+
+import pytest
+
+from separation_service import BadRequest, LocalClient, SeparationService
+
+def stub_model(tmp_path, gate=None):
+    # the parts of the model module the service uses, without Demucs
+    def separate(result, model_name, track, cancel_event=None, on_segment=None, **kwargs):
+        if gate is not None:
+            gate.wait(5)
+        on_segment({"segment_offset": 0, "audio_length": 2})
+        return "origin", {"vocals": "v", "drums": "d"}, 44100
+
+    def save_stems(origin, stems, track, model_name, samplerate, result, ext="mp3", progress=None, **kwargs):
+        paths = dict()
+        for done, name in enumerate(stems, 1):
+            paths[name] = str(tmp_path / f"{track}.{name}.{ext}")
+            progress(name, done, len(stems))
+        return [paths]
+
+    return types.SimpleNamespace(
+        MODELS=("htdemucs",),
+        DEFAULT_QUALITY="balanced",
+        QUALITY_PRESETS={"balanced": {}},
+        MODEL_CACHE=dict(),
+        model_cache_lock=threading.Lock(),
+        get_device=lambda: "cpu",
+        separation_params=lambda model_name, quality: {"model": model_name, "quality": quality},
+        separate=separate,
+        save_stems=save_stems,
+    )
+
+@pytest.fixture
+def track(tmp_path):
+    path = tmp_path / "song.wav"
+    path.write_bytes(b"")
+    return str(path)
+
+def start_service(tmp_path, gate=None):
+    return SeparationService(store_path=None, model=stub_model(tmp_path, gate)).start()
+
+def test_submit_streams_events_until_done(tmp_path, track):
+    service = start_service(tmp_path)
+    client = LocalClient(service)
+    submitted = client.submit("split", {"model": "htdemucs", "track": track})
+    events = [event["event"] for event in client.events(submitted["id"])]
+    assert events == ["queued", "segment", "separated", "saved", "saved", "done"]
+    status = client.status(submitted["id"])
+    assert status["state"] == "done"
+    assert all(os.path.isabs(path) for path in status["result"].values())
+    service.stop()
+
+def test_identical_requests_share_a_job(tmp_path, track):
+    gate = threading.Event()
+    service = start_service(tmp_path, gate)
+    client = LocalClient(service)
+    params = {"model": "htdemucs", "track": track}
+    first = client.submit("split", params)
+    second = client.submit("split", dict(params))
+    assert second == {"id": first["id"], "deduplicated": True}
+    gate.set()
+    assert client.wait(first["id"])["state"] == "done"
+    # once finished, the same request runs again
+    assert client.submit("split", params)["deduplicated"] is False
+    service.stop()
+
+@pytest.mark.parametrize("kind, params", [
+    ("split", {"model": "unknown"}),
+    ("split", {"model": "htdemucs", "track": "missing.wav"}),
+    ("split", {"model": "htdemucs", "quality": "extreme"}),
+    ("split", {"model": "htdemucs", "name": "../escape"}),
+    ("split", {"model": "htdemucs", "ext": "exe"}),
+    ("export", {"model": "htdemucs", "name": "song", "path": "song.mp3"}),
+    ("delete", {"model": "htdemucs"}),
+])
+def test_invalid_requests_are_rejected(tmp_path, track, kind, params):
+    service = SeparationService(store_path=None, model=stub_model(tmp_path))
+    params = dict({"track": track}, **params)
+    with pytest.raises(BadRequest):
+        service.submit(kind, params)
+    assert service.scheduler.pending() == []
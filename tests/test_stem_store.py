@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from stem_store import open_stem_file, write_packed_stem_file, write_stem_file
+
+@pytest.fixture
+def stems():
+    rng = np.random.default_rng(0)
+    # full-scale noise makes the int16 deltas wrap around
+    return {
+        "vocals": rng.integers(-32768, 32768, (2, 2500), dtype=np.int16),
+        "drums": (np.sin(np.arange(2500) / 10) * 20000).astype(np.int16)[None].repeat(2, axis=0),
+    }
+
+@pytest.mark.parametrize("packed", [True, False])
+def test_stem_file_round_trip(tmp_path, stems, packed):
+    path = str(tmp_path / "song.stems")
+    if packed:
+        write_packed_stem_file(path, stems, 44100, metadata={"model": "htdemucs"}, block_frames=1000)
+    else:
+        write_stem_file(path, stems, 44100, metadata={"model": "htdemucs"}, packed=False)
+    header, audio = open_stem_file(path)
+    assert header["packed"] is packed
+    assert (header["samplerate"], header["stems"], header["metadata"]) == (44100, ["vocals", "drums"], {"model": "htdemucs"})
+    expected = np.stack(list(stems.values()))
+    assert audio.shape == expected.shape
+    np.testing.assert_array_equal(np.asarray(audio), expected)
+    # slices across block boundaries
+    np.testing.assert_array_equal(audio[:, :, 900:2100], expected[:, :, 900:2100])
+    np.testing.assert_array_equal(audio[1, 0, 1999:2001], expected[1, 0, 1999:2001])
+    np.testing.assert_array_equal(audio[0, :, 2400:3000], expected[0, :, 2400:])
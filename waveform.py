@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Waveform peaks are kept as a pyramid of (min, max) pairs per block: level 0
+# covers BLOCK frames per pair and every further level halves the resolution,
+# down to about MIN_BLOCKS pairs. Drawing any time range then only touches the
+# coarsest level that still has a pair per pixel. Peaks are int16 on the PCM
+# scale and saved as peaks.npz next to the stems (songs under data/peaks).
+BLOCK = 256
+MIN_BLOCKS = 512
+PEAKS_FILE = "peaks.npz"
+SONG_PEAKS_DIR = os.path.join("data", "peaks")
+
+def block_peaks(audio, block=BLOCK):
+    # (blocks, 2) int16 min/max over all channels of a (channels, frames) array
+    scale = 1 if audio.dtype == np.int16 else 32767
+    frames = audio.shape[-1]
+    whole = frames // block
+    blocks = -(-frames // block)
+    peaks = np.empty((blocks, 2), dtype=np.int16)
+    if whole:
+        view = audio[:, :whole * block].reshape(audio.shape[0], whole, block)
+        peaks[:whole, 0] = np.clip(view.min(axis=(0, 2)) * scale, -32768, 32767)
+        peaks[:whole, 1] = np.clip(view.max(axis=(0, 2)) * scale, -32768, 32767)
+    if blocks > whole:
+        tail = audio[:, whole * block:]
+        peaks[whole] = np.clip([tail.min() * scale, tail.max() * scale], -32768, 32767)
+    return peaks
+
+def pyramid(peaks):
+    levels = [peaks]
+    while len(levels[-1]) > MIN_BLOCKS:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.concatenate([level, level[-1:]])
+        pairs = level.reshape(-1, 2, 2)
+        levels.append(np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1))
+    return levels
+
+class PeakIndex:
+    def __init__(self, levels, samplerate, frames, block=BLOCK):
+        # levels: {name: [level 0 peaks, level 1 peaks, ...]}
+        self.levels = levels
+        self.samplerate = samplerate
+        self.frames = frames
+        self.block = block
+
+    @classmethod
+    def from_audio(cls, stems, samplerate, block=BLOCK, scales=None):
+        # stems: {name: array of shape (channels, frames)}, int16 or float;
+        # scales: optional {name: factor} for int16 stems not on the PCM scale
+        levels = dict()
+        for name, audio in stems.items():
+            peaks = block_peaks(audio, block)
+            if scales is not None and name in scales:
+                peaks = np.clip(peaks * float(scales[name]), -32768, 32767).astype(np.int16)
+            levels[name] = pyramid(peaks)
+        frames = max(audio.shape[-1] for audio in stems.values())
+        return cls(levels, samplerate, frames, block)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            levels = {
+                name: [data[f"{name}:{level}"] for level in range(count)]
+                for name, count in meta["levels"].items()
+            }
+        return cls(levels, meta["samplerate"], meta["frames"], meta["block"])
+
+    def save(self, path):
+        meta = {
+            "samplerate": self.samplerate,
+            "frames": self.frames,
+            "block": self.block,
+            "levels": {name: len(levels) for name, levels in self.levels.items()},
+        }
+        arrays = {
+            f"{name}:{level}": peaks
+            for name, levels in self.levels.items()
+            for level, peaks in enumerate(levels)
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+        return path
+
+    @property
+    def names(self):
+        return list(self.levels)
+
+    @property
+    def duration(self):
+        return self.frames / self.samplerate
+
+    def view(self, name, start=0., end=None, width=1000):
+        # (times, mins, maxs) for [start, end) seconds with about `width`
+        # points, mins and maxs scaled to [-1, 1]
+        end = self.duration if end is None else end
+        span = max(end - start, 1 / self.samplerate) * self.samplerate
+        levels = self.levels[name]
+        level = 0
+        while level + 1 < len(levels) and span / (self.block * 2 ** (level + 1)) >= width:
+            level += 1
+        block = self.block * 2 ** level
+        first = max(int(start * self.samplerate) // block, 0)
+        last = min(-(-int(end * self.samplerate) // block), len(levels[level]))
+        peaks = levels[level][first:last]
+        times = (np.arange(first, first + len(peaks)) * block) / self.samplerate
+        return times, peaks[:, 0] / 32768, peaks[:, 1] / 32768
+
+def peaks_path(stem_path):
+    # the peaks of a stem set live in its track folder
+    return os.path.join(os.path.dirname(stem_path), PEAKS_FILE)
+
+def song_peaks_path(path):
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return os.path.join(SONG_PEAKS_DIR, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+def load_or_compute(path, stems, samplerate):
+    # reads the peaks at `path`, or computes them from `stems()` and saves them
+    if path is not None and os.path.isfile(path):
+        try:
+            return PeakIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            pass
+    index = PeakIndex.from_audio(stems(), samplerate)
+    if path is not None:
+        index.save(path)
+    return index